@@ -0,0 +1,101 @@
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Layer
+
+
+class AdaptiveSoftmax(Layer):
+    """ softmax output over `units` tokens split by frequency into a head and
+    tail clusters (Grave et al., Efficient softmax approximation for GPUs)
+
+    The head scores the `cutoffs[0]` most frequent tokens plus one entry per
+    tail cluster; tail cluster i scores the tokens ranked cutoffs[i] up to
+    cutoffs[i + 1] (or `units`) through a projection of the hidden state to
+    1 / factor ** (i + 1) of its size. `ranks` holds the frequency rank of every token id, see
+    `set_frequencies`.
+
+    Called on the hidden state it returns the probabilities of all tokens, in
+    token id order, like Dense + softmax. Called on [hidden state, token ids] it
+    adds their negative log likelihood as loss, only scoring the tail clusters
+    of the rows whose token is in them. """
+
+    def __init__(self, units, cutoffs, factor=4, **kwargs):
+        super(AdaptiveSoftmax, self).__init__(**kwargs)
+        self.units = units
+        self.cutoffs = [int(x) for x in cutoffs if 0 < x < units]
+        self.factor = factor
+
+    def build(self, input_shape):
+        # a list when built by the [hidden state, token ids] call
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        dim = int(input_shape[-1])
+        bounds = self.cutoffs + [self.units]
+        head_units = bounds[0] + len(self.cutoffs)
+        self.head_kernel = self.add_weight(name="head_kernel", shape=(dim, head_units),
+                                           initializer="glorot_uniform")
+        self.head_bias = self.add_weight(name="head_bias", shape=(head_units,),
+                                         initializer="zeros")
+        self.tails = []
+        for num, (low, high) in enumerate(zip(bounds[:-1], bounds[1:])):
+            tail_dim = max(1, dim // self.factor ** (num + 1))
+            self.tails.append((
+                self.add_weight(name="tail_{}_projection".format(num), shape=(dim, tail_dim),
+                                initializer="glorot_uniform"),
+                self.add_weight(name="tail_{}_kernel".format(num), shape=(tail_dim, high - low),
+                                initializer="glorot_uniform"),
+                self.add_weight(name="tail_{}_bias".format(num), shape=(high - low,),
+                                initializer="zeros")))
+        self.ranks = self.add_weight(name="ranks", shape=(self.units,), dtype="int32",
+                                     initializer="zeros", trainable=False)
+        self.ranks.assign(np.arange(self.units, dtype=np.int32))
+        super(AdaptiveSoftmax, self).build(input_shape)
+
+    def set_frequencies(self, frequencies):
+        """ ranks the token ids by how often they are answers, most frequent first """
+        order = np.argsort(-np.asarray(frequencies), kind="stable")
+        ranks = np.empty(self.units, dtype=np.int32)
+        ranks[order] = np.arange(self.units, dtype=np.int32)
+        self.ranks.assign(ranks)
+
+    def _tail_logits(self, num, hidden):
+        projection, kernel, bias = self.tails[num]
+        return tf.matmul(tf.matmul(hidden, projection), kernel) + bias
+
+    def call(self, inputs):
+        if isinstance(inputs, list):
+            hidden, labels = inputs
+            self.add_loss(tf.reduce_mean(self._nll(hidden, labels)))
+            return hidden
+        head = tf.nn.softmax(tf.matmul(inputs, self.head_kernel) + self.head_bias)
+        head_size = self.cutoffs[0] if self.cutoffs else self.units
+        by_rank = [head[:, :head_size]]
+        for num in range(len(self.tails)):
+            tail = tf.nn.softmax(self._tail_logits(num, inputs))
+            by_rank.append(head[:, head_size + num:head_size + num + 1] * tail)
+        return tf.gather(tf.concat(by_rank, axis=1), self.ranks, axis=1)
+
+    def _nll(self, hidden, labels):
+        ranks = tf.gather(self.ranks, tf.reshape(tf.cast(labels, tf.int32), [-1]))
+        bounds = tf.constant(self.cutoffs, dtype=tf.int32)
+        cluster = tf.reduce_sum(tf.cast(ranks[:, None] >= bounds[None, :], tf.int32), axis=1)
+        head_size = self.cutoffs[0] if self.cutoffs else self.units
+        head_target = tf.where(cluster == 0, ranks, head_size + cluster - 1)
+        head_log_probs = tf.nn.log_softmax(tf.matmul(hidden, self.head_kernel) + self.head_bias)
+        nll = -tf.gather(head_log_probs, head_target, batch_dims=1)
+        for num, low in enumerate(self.cutoffs):
+            rows = tf.where(cluster == num + 1)
+            tail_log_probs = tf.nn.log_softmax(self._tail_logits(num, tf.gather_nd(hidden, rows)))
+            target = tf.gather_nd(ranks, rows) - low
+            nll = tf.tensor_scatter_nd_add(nll, rows, -tf.gather(tail_log_probs, target,
+                                                                 batch_dims=1))
+        return nll
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            return input_shape[0]
+        return tuple(input_shape[:-1]) + (self.units,)
+
+    def get_config(self):
+        config = super(AdaptiveSoftmax, self).get_config()
+        config.update(units=self.units, cutoffs=self.cutoffs, factor=self.factor)
+        return config
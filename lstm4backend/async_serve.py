@@ -0,0 +1,127 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from aiohttp import web
+
+import serve
+from metrics import Gauge
+
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*",
+                "Access-Control-Allow-Methods": "GET, OPTIONS, POST",
+                "Access-Control-Max-Age": "21600",
+                "Access-Control-Allow-Headers": "Content-Type"}
+
+
+class Saturated(Exception):
+    pass
+
+
+class InferencePool(object):
+    """ bounded pool of inference threads in front of the blocking model calls
+
+    At most `workers` calls run at once and at most `max_queue` more wait for a
+    thread; anything beyond that is rejected right away with `Saturated`. A
+    call that does not finish within `timeout` seconds raises
+    `asyncio.TimeoutError`, but keeps holding its slot until the thread is
+    actually done, so timed out work still counts against the limits. """
+
+    def __init__(self, workers=4, max_queue=32, timeout=10.0):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="inference")
+        self.max_pending = workers + max_queue
+        self.timeout = timeout
+        self.pending = 0
+
+    async def run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            raise Saturated()
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._done(loop))
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+
+    def _done(self, loop):
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._release)
+
+    def _release(self):
+        self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def json_response(data, status=200, **headers):
+    headers.update(CORS_HEADERS)
+    return web.json_response(data, status=status, headers=headers)
+
+
+async def get_args(request):
+    if request.method == "POST":
+        return await request.json()
+    return request.query
+
+
+async def predict(request):
+    if request.method == "OPTIONS":
+        return json_response(None)
+    args = await get_args(request)
+    try:
+        data = await request.app["pool"].run(serve.run_predict, args)
+    except Saturated:
+        return json_response({"error": "server is saturated, retry later"}, status=503,
+                             **{"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        return json_response({"error": "prediction timed out"}, status=504)
+    return json_response(data)
+
+
+async def get_models(request):
+    if request.method == "OPTIONS":
+        return json_response(None)
+    return json_response(serve.run_get_models())
+
+
+async def get_metrics(request):
+    return web.Response(text=serve.metrics.render(),
+                        headers={"Content-Type": serve.metrics.content_type})
+
+
+async def on_cleanup(app):
+    app["pool"].shutdown()
+
+
+def make_app(workers=4, max_queue=32, timeout=10.0):
+    app = web.Application()
+    app["pool"] = InferencePool(workers, max_queue, timeout)
+    serve.metrics.add(Gauge("autocomplete_inference_pending",
+                            "Predictions running or waiting for an inference thread",
+                            lambda: {(): app["pool"].pending}))
+    app.router.add_route("GET", "/metrics", get_metrics)
+    for method in ["GET", "POST", "OPTIONS"]:
+        app.router.add_route(method, "/predict", predict)
+        app.router.add_route(method, "/get_models", get_models)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0', type=str,
+              help='Host IP')
+@click.option('-p', '--port', default=9078, type=int,
+              help='Host Port')
+@click.option('--workers', default=4, type=int,
+              help='Number of inference threads')
+@click.option('--max-queue', default=32, type=int,
+              help='Requests allowed to wait for an inference thread before answering 503')
+@click.option('--timeout', default=10.0, type=float,
+              help='Seconds before a prediction is answered with 504')
+@serve.serving_options
+def main(host, port, workers, max_queue, timeout, **options):
+    serve.configure(**options)
+    web.run_app(make_app(workers, max_queue, timeout), host=host, port=port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import numpy as np
+from tensorflow.keras.utils import Sequence
+
+
+class WindowBatches(Sequence):
+    """ the training windows of a streaming `EncoderDecoder` as shuffled batches,
+    encoded when Keras asks for them; `fit` prepares the next batches on its
+    worker threads while the current one trains.
+
+    The order of an epoch only depends on `seed` and the epoch number, so a
+    resumed run can pick up an epoch at the batch it was interrupted at.
+
+    With `answers_as_input` a batch is only the inputs {"question": X,
+    "answer": answer ids}, for a model that computes its own loss, see
+    `LSTMBase.build_training_model`. """
+
+    def __init__(self, encoder_decoder, batch_size=256, shuffle=True, seed=None,
+                 answers_as_input=False):
+        self.encoder_decoder = encoder_decoder
+        self.answers_as_input = answers_as_input
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start=0):
+        """ the batches of `epoch`, leaving out the first `start` of them """
+        self.epoch = epoch
+        self.start = start
+        num_windows = len(self.encoder_decoder.window_starts)
+        if self.shuffle:
+            self.order = np.random.RandomState(self.seed + epoch).permutation(num_windows)
+        else:
+            self.order = np.arange(num_windows)
+
+    def __len__(self):
+        return (len(self.order) + self.batch_size - 1) // self.batch_size - self.start
+
+    def __getitem__(self, index):
+        index += self.start
+        windows = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        X, y = self.encoder_decoder.window_batch(windows)
+        if self.answers_as_input:
+            answers = y if self.encoder_decoder.sparse else y.argmax(axis=1)
+            return ({"question": X, "answer": answers},)
+        return X, y
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
@@ -0,0 +1,234 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class Closed(Exception):
+    """ raised for requests to a batcher that was closed, e.g. because its model was evicted """
+
+
+class TokenStream(object):
+    """ the (index, token) pairs of a streamed request, as the batcher decodes them;
+    `close` stops decoding the request's rows """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.cancelled = False
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class StepCosts(object):
+    """ running estimate of the seconds one decoding step of a model takes """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.seconds = None
+
+    def observe(self, seconds):
+        if self.seconds is None:
+            self.seconds = seconds
+        else:
+            self.seconds += self.smoothing * (seconds - self.seconds)
+
+    def steps_within(self, budget, max_steps, safety=0.8):
+        """ how many steps fit into `budget` seconds, at most `max_steps` """
+        if self.seconds is None or self.seconds <= 0:
+            return max_steps
+        return max(1, min(max_steps, int(budget * safety / self.seconds)))
+
+    def overruns(self, deadline):
+        """ whether one more step would likely end past `deadline` (a time.monotonic value) """
+        return deadline is not None and time.monotonic() + (self.seconds or 0) > deadline
+
+
+class MicroBatcher(object):
+    """ coalesces concurrent completion requests for one model into batched decoding
+
+    Requests are collected for up to `max_wait_ms` milliseconds or until
+    `max_batch` of them are waiting. All rows of the collected requests are then
+    decoded together by a single `LSTMBase.generate` call, so every decoding step
+    is one forward pass for everybody, and each caller gets its own predictions
+    back. Beam searches are queued the same way but run one request at a time.
+    A request can carry its own step limit and a deadline, its rows leave the
+    batch as soon as another step would overrun either; `step_costs` learns how
+    long a step of the model takes. Since all decoding for the model happens on
+    the batcher's thread, the model is never used by two requests at once. It
+    can be passed to `complete` in place of the model. """
+
+    def __init__(self, model, max_wait_ms=2.0, max_batch=16):
+        self.model = model
+        self.max_wait_ms = max_wait_ms
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.step_costs = StepCosts()
+        # called with the number of steps decoded for every request when set
+        self.on_steps = None
+        self.closed = False
+        # orders the requests before the `close` marker in the queue
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="batcher-" + model.model_name)
+        self._thread.start()
+
+    @property
+    def model_name(self):
+        return self.model.model_name
+
+    @property
+    def encoder_decoder(self):
+        return self.model.encoder_decoder
+
+    @property
+    def sampling_top_k(self):
+        return self.model.sampling_top_k
+
+    def predict_batch(self, text, diversities, max_prediction_steps, break_at_token=None,
+                      stateful=False, deadline=None, top_k=None):
+        return self._submit("sample",
+                            (text, list(diversities), max_prediction_steps, deadline, None),
+                            (break_at_token, stateful, top_k))
+
+    def stream(self, text, diversities, max_prediction_steps, break_at_token=None,
+               stateful=False, deadline=None, top_k=None):
+        """ like `predict_batch`, but returns a `TokenStream` right away """
+        stream = TokenStream()
+        self._put((("sample", (break_at_token, stateful, top_k)),
+                   (text, list(diversities), max_prediction_steps, deadline, stream), Future()))
+        return stream
+
+    def beam_search(self, text, beam_width, max_prediction_steps, break_at_token=None,
+                    deadline=None):
+        return self._submit("beam", (text, beam_width, max_prediction_steps, break_at_token,
+                                     deadline), ())
+
+    def _submit(self, kind, inputs, params):
+        future = Future()
+        self._put(((kind, params), inputs, future))
+        return future.result()
+
+    def _put(self, item):
+        with self._lock:
+            if self.closed:
+                raise Closed("the batcher of {} is closed".format(self.model_name))
+            self.queue.put(item)
+
+    def close(self):
+        """ stops the batcher once the requests queued so far are decoded; later
+        requests raise `Closed` """
+        with self._lock:
+            self.closed = True
+            self.queue.put(None)
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        closed = False
+        while not closed:
+            groups = {}
+            for item in self._collect():
+                if item is None:
+                    closed = True
+                    continue
+                group_key, inputs, future = item
+                groups.setdefault(group_key, []).append((inputs, future))
+            for (kind, params), group in groups.items():
+                if kind == "beam":
+                    for inputs, future in group:
+                        self._run_future(future, self.model.beam_search, *inputs)
+                else:
+                    self._decode(group, *params)
+        # nothing is queued after the close marker, this is only a safeguard
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                _, inputs, future = item
+                error = Closed("the batcher of {} is closed".format(self.model_name))
+                future.set_exception(error)
+                if item[0][0] == "sample" and inputs[4] is not None:
+                    inputs[4].put(error)
+
+    def _run_future(self, future, fn, *args):
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _decode(self, group, break_at_token, stateful, top_k):
+        texts, diversities, owners, offsets = [], [], [], []
+        for num, ((text, request_diversities, _, _, _), _) in enumerate(group):
+            offsets.append(len(texts))
+            texts.extend([text] * len(request_diversities))
+            diversities.extend(request_diversities)
+            owners.extend([num] * len(request_diversities))
+        max_steps = [inputs[2] for inputs, _ in group]
+        deadlines = [inputs[3] for inputs, _ in group]
+        streams = [inputs[4] for inputs, _ in group]
+        outputs = [[] for _ in texts]
+
+        def cancelled(row):
+            num = owners[row]
+            if streams[num] is not None and streams[num].cancelled:
+                return True
+            # the token of this step is not in `outputs` yet
+            return (len(outputs[row]) + 1 >= max_steps[num]
+                    or self.step_costs.overruns(deadlines[num]))
+
+        try:
+            started = time.monotonic()
+            for step in self.model.generate(texts, diversities, max(max_steps),
+                                            break_at_token, stateful, cancelled, top_k):
+                self.step_costs.observe(time.monotonic() - started)
+                for row, token in step:
+                    outputs[row].append(token)
+                    stream = streams[owners[row]]
+                    if stream is not None:
+                        stream.put((row - offsets[owners[row]], token))
+                started = time.monotonic()
+        except Exception as e:
+            for (_, future), stream in zip(group, streams):
+                future.set_exception(e)
+                if stream is not None:
+                    stream.put(e)
+            return
+        results = [[] for _ in group]
+        steps = [0] * len(group)
+        for num, output in zip(owners, outputs):
+            results[num].append(self.model.encoder_decoder.untokenize(output))
+            steps[num] = max(steps[num], len(output))
+        if self.on_steps is not None:
+            for num_steps in steps:
+                self.on_steps(num_steps)
+        for (_, future), result, stream in zip(group, results, streams):
+            future.set_result(result)
+            if stream is not None:
+                stream.put(None)
@@ -0,0 +1,198 @@
+import json
+import os
+import platform
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+
+
+def load_log(path):
+    """ reads /predict requests captured with `serve.py --capture`, one JSON object per line """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def keystrokes(paths, model_names, every=3, guess=3, max_chars=2000):
+    """ synthetic traffic: the requests an editor sends while the files are typed in,
+    one every `every` characters, in turn for each model """
+    requests = []
+    for path in paths:
+        with open(path) as f:
+            text = f.read()[:max_chars]
+        for end in range(every, len(text) + 1, every):
+            for model_name in model_names:
+                requests.append({"keyword": text[:end], "model": model_name, "guess": guess})
+    return requests
+
+
+def arrivals(requests, rate=None, speed=None, seed=None):
+    """ start times, in seconds from the start of the run, of an open-loop replay:
+    Poisson arrivals at `rate` requests per second, or the captured times sped up
+    by `speed`. None when the requests are sent in a closed loop """
+    if rate:
+        gaps = np.random.RandomState(seed).exponential(1.0 / rate, len(requests))
+        return np.cumsum(gaps) - gaps[0]
+    if speed:
+        times = np.array([r.get("t", 0) for r in requests], dtype=float)
+        return (times - times.min()) / speed
+    return None
+
+
+def in_process(engine="numpy"):
+    """ calls serve.py's /predict in this process, without the HTTP round trip """
+    import serve
+    serve.configure(10000, 64, 600, 0.3, 2.0, 16, 0, (), engine)
+    client = serve.app.test_client()
+
+    def send(args):
+        response = client.post("/predict", json=args)
+        if response.status_code != 200:
+            raise IOError("HTTP {}".format(response.status_code))
+        return response.get_json()
+    return send
+
+
+def over_http(url, timeout=30.0):
+    """ posts to the /predict endpoint of a running server at `url` """
+    url = url.rstrip("/") + "/predict"
+
+    def send(args):
+        data = json.dumps(args).encode("utf-8")
+        req = urllib.request.Request(url, data, {"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+    return send
+
+
+def run(send, requests, concurrency=8, starts=None):
+    """ sends the requests and returns one (model, seconds, ok) per request.
+
+    Closed loop when `starts` is None: `concurrency` clients each send their next
+    request as soon as the previous one is answered. Open loop otherwise: request i
+    is sent at `starts[i]`, whether earlier ones were answered or not, and its latency
+    counts from that time so a slow server is not hidden by a late send """
+    results = [None] * len(requests)
+    began = time.perf_counter()
+
+    def one(i, scheduled):
+        try:
+            send(requests[i])
+            ok = True
+        except Exception:
+            ok = False
+        results[i] = (requests[i].get("model", "char"), time.perf_counter() - scheduled, ok)
+
+    if starts is None:
+        position = iter(range(len(requests)))
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    i = next(position, None)
+                if i is None:
+                    return
+                one(i, time.perf_counter())
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+    else:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for i, start in enumerate(starts):
+                delay = began + start - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, i, began + start)
+    return results, time.perf_counter() - began
+
+
+def summarize(results, elapsed):
+    """ throughput, error count and latency percentiles in ms, overall and per model """
+    def stats(rows):
+        latencies = np.array([seconds for _, seconds, ok in rows if ok]) * 1000.0
+        summary = {"requests": len(rows), "errors": sum(1 for row in rows if not row[2]),
+                   "throughput": len(rows) / elapsed if elapsed else 0.0}
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            summary.update(mean_ms=float(latencies.mean()), p50_ms=float(p50),
+                           p95_ms=float(p95), p99_ms=float(p99), max_ms=float(latencies.max()))
+        return summary
+
+    models = sorted(set(model for model, _, _ in results))
+    return {"elapsed": elapsed, "all": stats(results),
+            "models": {m: stats([row for row in results if row[0] == m]) for m in models}}
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--log', 'log_path', default=None, type=click.Path(exists=True),
+              help='Replay requests captured with serve.py --capture')
+@click.option('--source', multiple=True, type=click.Path(exists=True),
+              help='Generate keystroke traffic from typing this file, can be repeated')
+@click.option('--model', 'model_names', multiple=True, default=['24_token'],
+              help='Model of the keystroke traffic, can be repeated')
+@click.option('--url', default=None,
+              help='Server to load, e.g. http://localhost:9078; defaults to serve.py in-process')
+@click.option('--engine', default='numpy', type=click.Choice(['keras', 'numpy']),
+              help='Engine of the in-process server')
+@click.option('--concurrency', default=8, type=int,
+              help='Concurrent clients, or sender threads of an open-loop run')
+@click.option('--rate', default=None, type=float,
+              help='Open loop: send Poisson arrivals at this many requests per second')
+@click.option('--speed', default=None, type=float,
+              help='Open loop: replay the captured arrival times this many times faster')
+@click.option('--requests', 'limit', default=None, type=int,
+              help='Measure at most this many requests')
+@click.option('--warm-up', 'warm_up', default=10, type=int,
+              help='Send this many of the first requests before measuring the others, '
+                   'e.g. to load the models')
+@click.option('--seed', default=0, type=int,
+              help='Seed of the arrival times')
+@click.option('-o', '--output', default='benchmark.json', type=click.Path(dir_okay=False),
+              help='Write the report to this JSON file')
+def main(log_path, source, model_names, url, engine, concurrency, rate, speed, limit, warm_up,
+         seed, output):
+    """ load-tests the completion server with captured or synthetic requests and writes
+    throughput and p50/p95/p99 latency per model to a JSON report, to compare across commits """
+    if log_path:
+        requests = load_log(log_path)
+    elif source:
+        requests = keystrokes(source, model_names)
+    else:
+        raise click.UsageError("give a captured --log or a --source file to type")
+    # repeats of the warm-up requests could be answered from the completion cache
+    warm_up_requests, requests = requests[:warm_up], requests[warm_up:][:limit]
+    send = over_http(url) if url else in_process(engine)
+    for args in warm_up_requests:
+        send(args)
+    results, elapsed = run(send, requests, concurrency, arrivals(requests, rate, speed, seed))
+    report = summarize(results, elapsed)
+    report["config"] = {"log": log_path, "source": list(source), "url": url,
+                        "engine": None if url else engine, "concurrency": concurrency,
+                        "rate": rate, "speed": speed, "seed": seed,
+                        "revision": revision(), "python": platform.python_version(),
+                        "cpus": os.cpu_count(), "time": time.time()}
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for name, summary in sorted(report["models"].items()):
+        print("{:12} {:6d} requests {:8.1f}/s  p50 {:7.1f}ms  p95 {:7.1f}ms  p99 {:7.1f}ms".format(
+            name, summary["requests"], summary["throughput"], summary.get("p50_ms", float("nan")),
+            summary.get("p95_ms", float("nan")), summary.get("p99_ms", float("nan"))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+
+def _sizeof(key, value):
+    """ rough number of bytes held by a cache entry """
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    for x in list(key) + list(value):
+        size += sys.getsizeof(x)
+    return size
+
+
+class CompletionCache(object):
+    """ in-process LRU cache of completions with a time-to-live and a memory cap
+
+    Keys are built by the caller from everything that determines a completion:
+    the model name, the encoded input window the model sees and the decoding
+    parameters. Requests sampling above `max_temperature` are never cached, so
+    random high-temperature suggestions keep varying. """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 2 ** 20, ttl=600, max_temperature=0.3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def cacheable(self, diversities, beam=False):
+        """ whether the completions of a request are cached; those of a beam search
+        do not depend on the diversities """
+        if self.max_entries <= 0:
+            return False
+        return beam or max(diversities, default=0) <= self.max_temperature
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        size = _sizeof(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), value, size)
+            self.num_bytes += size
+            while len(self._entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "entries": len(self._entries), "bytes": self.num_bytes}
+
+    def _remove(self, key):
+        self.num_bytes -= self._entries.pop(key)[2]
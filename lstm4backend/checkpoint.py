@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.models import load_model
+
+
+class Checkpoints(object):
+    """ training checkpoints in `directory`: the model with its optimizer state
+    and a JSON training state, in a numbered subdirectory each. The file
+    LATEST names the newest complete one; it is only replaced once that
+    subdirectory is fully written, so a crash at any point leaves the previous
+    checkpoint usable. The newest `keep` checkpoints are kept; `custom_objects`
+    are passed on to `load_model`.
+
+    A model trained through a separate training model, see
+    `LSTMBase.build_training_model`, is saved without optimizer; the weights
+    of the training model's optimizer are saved next to it instead, see
+    `restore_optimizer`. """
+
+    def __init__(self, directory, keep=2, custom_objects=None):
+        self.directory = directory
+        self.keep = keep
+        self.custom_objects = custom_objects
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def latest(self):
+        try:
+            with open(self._path("LATEST")) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def load(self):
+        """ the model and state of the latest checkpoint, None when there is none """
+        name = self.latest()
+        if name is None:
+            return None
+        with open(self._path(name, "state.json")) as f:
+            state = json.load(f)
+        return load_model(self._path(name, "model.h5"), self.custom_objects), state
+
+    def restore_optimizer(self, model):
+        """ sets the optimizer weights saved with the latest checkpoint on the compiled
+        `model`, returns False when there are none """
+        name = self.latest()
+        if name is None or not os.path.isfile(self._path(name, "optimizer.npz")):
+            return False
+        with np.load(self._path(name, "optimizer.npz")) as f:
+            weights = [f["arr_{}".format(num)] for num in range(len(f.files))]
+        model.optimizer.build(model.trainable_variables)
+        model.optimizer.set_weights(weights)
+        return True
+
+    def save(self, model, state, optimizer=None):
+        """ saves `model` and `state`, and the weights of `optimizer` when given """
+        os.makedirs(self.directory, exist_ok=True)
+        name = "checkpoint-{:08d}-{:08d}".format(state["epoch"], state["batch"])
+        partial = self._path(name + ".partial")
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        model.save(os.path.join(partial, "model.h5"))
+        if optimizer is not None:
+            np.savez(os.path.join(partial, "optimizer.npz"),
+                     *[np.asarray(x) for x in optimizer.variables])
+        with open(os.path.join(partial, "state.json"), "w") as f:
+            json.dump(state, f)
+        shutil.rmtree(self._path(name), ignore_errors=True)
+        os.rename(partial, self._path(name))
+        with open(self._path("LATEST.partial"), "w") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._path("LATEST.partial"), self._path("LATEST"))
+        names = sorted(x for x in os.listdir(self.directory) if x.startswith("checkpoint-")
+                       and not x.endswith(".partial"))
+        for old in names[:-self.keep]:
+            shutil.rmtree(self._path(old), ignore_errors=True)
+
+
+class CheckpointCallback(Callback):
+    """ keeps `state` (epoch, batch) up to date during `fit` and saves a checkpoint
+    at the end of every epoch and, with `every_batches`, every that many batches.
+    `saved_model` is saved instead of the model being fit when given, e.g. the
+    inference model sharing its layers with a training model, together with
+    the optimizer weights of the model being fit. """
+
+    def __init__(self, checkpoints, state, every_batches=None, saved_model=None):
+        super(CheckpointCallback, self).__init__()
+        self.checkpoints = checkpoints
+        self.state = state
+        self.every_batches = every_batches
+        self.saved_model = saved_model
+        self.start = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = self.state["batch"]
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.every_batches:
+            self.state["batch"] = self.start + batch + 1
+            if (batch + 1) % self.every_batches == 0:
+                self._save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.state.update(epoch=epoch + 1, batch=0)
+        self._save()
+
+    def _save(self):
+        if self.saved_model is None or self.saved_model is self.model:
+            self.checkpoints.save(self.model, self.state)
+        else:
+            self.checkpoints.save(self.saved_model, self.state, self.model.optimizer)
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+
+def shard_paths(root="./data/python/"):
+    """ the gzipped JSONL shards of the CodeSearchNet dump under `root` """
+    return sorted(Path(root).glob('**/*.gz'))
+
+
+def fingerprint(paths, *extra):
+    """ a hash of the names and contents of the files, and of `extra` """
+    digest = hashlib.sha256(json.dumps([str(x) for x in extra]).encode("utf-8"))
+    for path in paths:
+        digest.update(Path(path).name.encode("utf-8") + b"\0")
+        with open(str(path), "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_shard(path, fields=("code",), partitions=None):
+    """ the `fields` of every record of one shard as a tuple, leaving out the
+    records whose `partition` is not in `partitions` (when given) """
+    rows = []
+    with gzip.open(str(path), "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if partitions is None or record.get("partition") in partitions:
+                rows.append(tuple(record.get(x) for x in fields))
+    return rows
+
+
+def bounded_map(fn, items, processes=None, prefetch=None, pool=None):
+    """ yields fn(item) for the items, in order, computed by a pool of `processes`
+    processes (all CPUs when None), of which at most `prefetch` (twice the pool
+    size by default) are computed ahead of the one being yielded, so neither
+    the items nor the results all have to fit in memory.
+
+    An existing `pool` (a ProcessPoolExecutor) is used instead when given, so
+    that the stages of a pipeline, e.g. reading and tokenizing, share their
+    processes rather than each starting as many as there are CPUs. """
+    if pool is None:
+        with ProcessPoolExecutor(processes) as pool:
+            yield from bounded_map(fn, items, processes, prefetch, pool)
+        return
+    prefetch = prefetch or 2 * (processes or os.cpu_count())
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def read_records(paths, fields=("code",), partitions=None, processes=None, prefetch=None,
+                 pool=None):
+    """ yields the `fields` of the records of the shards, in order, see `read_shard`.
+
+    The shards are decompressed and parsed in other processes, see
+    `bounded_map`, so the whole corpus is never in memory. """
+    partitions = None if partitions is None else set(partitions)
+    read = partial(read_shard, fields=tuple(fields), partitions=partitions)
+    for rows in bounded_map(read, paths, processes, prefetch, pool):
+        yield from rows
+
+
+def read_code(paths, partitions=None, processes=None, pool=None):
+    """ yields the code of the records of the shards, see `read_records` """
+    for code, in read_records(paths, ("code",), partitions, processes, pool=pool):
+        yield code
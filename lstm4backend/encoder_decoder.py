@@ -1,36 +1,244 @@
-from collections import Counter
+from collections import Counter, OrderedDict
+from functools import partial
+from itertools import islice
+import json
+import threading
+import time
 import numpy as np
 
+from corpus import bounded_map
+
 import tokenize as tk
 from io import BytesIO
 
 
-def text_tokenize(txt):
-    """ specific tokenizer suitable for extracting 'python tokens' """
-    toks = []
+def _python_tokens(txt, indents=()):
+    """ the token strings of `txt`, with the spaces between tokens on a line,
+    and the logical line ends as (offset in txt, number of tokens up to it,
+    indentation stack after it).
+
+    `indents` is the stack of indentation strings `txt` starts in; it is
+    recreated by tokenizing a few nested `if 1:` lines in front of `txt`. """
+    preamble = "".join(x + "if 1:\n" for x in ("",) + tuple(indents[:-1]))
+    preamble = preamble + indents[-1] + "pass\n" if indents else ""
+    num_preamble_lines = preamble.count("\n")
+    line_offsets = [0]
+    for line in txt.split("\n"):
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+    stack = list(indents)
+    tokkies = []
+    line_ends = []
+    old = (0, 0)
     try:
-        for x in tk.tokenize(BytesIO(txt.encode('utf-8')).readline):
-            toks.append(x)
+        for t in tk.tokenize(BytesIO((preamble + txt).encode('utf-8')).readline):
+            if t.type == tk.ENCODING or t.start[0] <= num_preamble_lines:
+                continue
+            if t.type == tk.INDENT:
+                stack.append(t.string)
+            elif t.type == tk.DEDENT:
+                stack.pop()
+            if not t.string:
+                continue
+            if t.start[0] == old[0] and t.start[1] > old[1]:
+                tokkies.append(" " * (t.start[1] - old[1]))
+            tokkies.append(t.string)
+            old = t.end
+            if t.type == tk.NEWLINE:
+                offset = line_offsets[t.start[0] - num_preamble_lines]
+                line_ends.append((offset, len(tokkies), tuple(stack)))
     except tk.TokenError:
         pass
-    tokkies = []
-    old = (0, 0)
-    for t in toks:
-        if not t.string:
-            continue
-        if t.start[0] == old[0] and t.start[1] > old[1]:
-            tokkies.append(" " * (t.start[1] - old[1]))
-        tokkies.append(t.string)
-        old = t.end
+    return tokkies, line_ends
+
+
+def _finish_tokens(txt, tokkies):
     if txt.endswith(" "):
-        tokkies.append(" ")
-    toks = [x for x in tokkies if not x.startswith("#")]
-    return toks[1:]
+        tokkies = tokkies + [" "]
+    return [x for x in tokkies if not x.startswith("#")]
+
+
+def text_tokenize(txt):
+    """ specific tokenizer suitable for extracting 'python tokens' """
+    return _finish_tokens(txt, _python_tokens(txt)[0])
+
+
+def pad_tokens(tokens, padding, maxlen):
+    """ `tokens` preceded by enough `padding` for a first window of `maxlen` """
+    return [padding] * (maxlen - len(tokens) + 1) + tokens
+
+
+def _tokenize_chunk(tokenize, texts, windows=None):
+    """ the tokens of the texts; with `windows` (padding, maxlen, window_step) the
+    padded tokens and window starts of every text, and their `WindowCounts` """
+    tokenized = [tokenize(text) for text in texts]
+    if windows is None:
+        return tokenized
+    padding, maxlen, window_step = windows
+    counts = WindowCounts(maxlen, window_step)
+    padded = [pad_tokens(tokens, padding, maxlen) for tokens in tokenized]
+    return [(text, counts.add(text)) for text in padded], counts
+
+
+def tokenize_texts(texts, tokenize, processes=None, chunk_size=64, prefetch=None, pool=None,
+                   counts=None, padding=None):
+    """ yields `tokenize(text)` for each of the texts, in order.
+
+    The texts are tokenized in chunks of `chunk_size` by a pool of `processes`
+    processes (all CPUs when None, in this process when 1) or by `pool`, with
+    at most `prefetch` chunks in flight, see `bounded_map`; so `tokenize` has
+    to be picklable, e.g. `text_tokenize` or `list`. The throughput is printed
+    at the end.
+
+    With `counts` (a `WindowCounts`) the windows of the tokens padded with
+    `padding` are counted by the same processes, and (padded tokens, window
+    starts) is yielded instead; the counts of a chunk are merged into `counts`
+    before its texts are yielded. """
+    started = time.time()
+    num_texts = num_tokens = 0
+    texts = iter(texts)
+    chunks = iter(lambda: list(islice(texts, chunk_size)), [])
+    windows = None if counts is None else (padding, counts.maxlen, counts.window_step)
+    tokenize_chunk = partial(_tokenize_chunk, tokenize, windows=windows)
+    if processes == 1 and pool is None:
+        results = (tokenize_chunk(chunk) for chunk in chunks)
+    else:
+        results = bounded_map(tokenize_chunk, chunks, processes, prefetch, pool)
+    for chunk in results:
+        if counts is not None:
+            chunk, chunk_counts = chunk
+            counts.update(chunk_counts)
+        for item in chunk:
+            num_texts += 1
+            num_tokens += len(item if counts is None else item[0])
+            yield item
+    seconds = max(time.time() - started, 1e-9)
+    print("tokenized {} texts, {} tokens in {:.1f}s: {:.0f} texts/s, {:.0f} tokens/s".format(
+        num_texts, num_tokens, seconds, num_texts / seconds, num_tokens / seconds))
+
+
+class TokenizeCache(object):
+    """ `text_tokenize` for texts that mostly extend previously tokenized ones,
+    like a document being typed or a completion being decoded
+
+    It remembers the tokens of a text up to its last complete logical line.
+    A later text starting with that same prefix is only tokenized from there
+    on, in the indentation the prefix left it in. At most `max_entries`
+    prefixes of together `max_chars` characters are kept. With `check`, the
+    result is compared to a from-scratch `text_tokenize`, which is returned
+    (and counted in `mismatches`) when they differ. """
+
+    def __init__(self, max_entries=1024, max_chars=2 ** 22, max_lookback=64, check=False):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.max_lookback = max_lookback
+        self.check = check
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self.num_chars = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, txt):
+        start, prefix_tokkies, indents = self._lookup(txt)
+        tokkies, line_ends = _python_tokens(txt[start:], indents)
+        if line_ends:
+            offset, num_tokkies, line_indents = line_ends[-1]
+            if offset > 0:
+                self._store(txt[:start + offset], prefix_tokkies + tuple(tokkies[:num_tokkies]),
+                            line_indents)
+        toks = _finish_tokens(txt, list(prefix_tokkies) + tokkies)
+        if self.check:
+            expected = text_tokenize(txt)
+            if toks != expected:
+                self.mismatches += 1
+                toks = expected
+        return toks
+
+    def _lookup(self, txt):
+        end = len(txt)
+        with self._lock:
+            for _ in range(self.max_lookback):
+                end = txt.rfind("\n", 0, end)
+                if end < 0:
+                    break
+                entry = self._entries.get(txt[:end + 1])
+                if entry is not None:
+                    self._entries.move_to_end(txt[:end + 1])
+                    self.hits += 1
+                    return end + 1, entry[0], entry[1]
+            self.misses += 1
+        return 0, (), ()
+
+    def _store(self, prefix, tokkies, indents):
+        with self._lock:
+            if prefix in self._entries:
+                return
+            self._entries[prefix] = (tokkies, indents)
+            self.num_chars += len(prefix)
+            while len(self._entries) > self.max_entries or self.num_chars > self.max_chars:
+                self.num_chars -= len(self._entries.popitem(last=False)[0])
+
+
+class WindowCounts(object):
+    """ how often every token occurs in the question windows and as the answer
+    of the padded texts added, as `build_data` would count them. A token is
+    counted once per text, weighted by the number of windows covering it,
+    rather than once per window.
+
+    Counts of consecutive parts of the texts, made by the processes of
+    `tokenize_texts`, merge in text order with `update` into the counts of
+    all of them. """
+
+    def __init__(self, maxlen, window_step):
+        self.maxlen = maxlen
+        self.window_step = window_step
+        self.questions = Counter()
+        self.answers = Counter()
+        self.num_windows = 0
+
+    def add(self, text):
+        """ counts the windows of the padded tokens `text`, returns their starts """
+        starts = range(0, len(text) - self.maxlen, self.window_step)
+        if not starts:
+            return starts
+        last, step = starts[-1], self.window_step
+        for position, x in enumerate(text[:last + self.maxlen]):
+            first = max(0, position - self.maxlen + 1)
+            covering = min(position, last) // step - (first + step - 1) // step + 1
+            if covering > 0:
+                self.questions[x] += covering
+        for i in starts:
+            self.answers[text[i + self.maxlen]] += 1
+        self.num_windows += len(starts)
+        return starts
+
+    def update(self, other):
+        self.questions.update(other.questions)
+        self.answers.update(other.answers)
+        self.num_windows += other.num_windows
+
+
+def _num_ids(decoder):
+    """ the number of ids of an index to token dict, counting unused ones, or list """
+    return len(decoder) if isinstance(decoder, list) else max(decoder) + 1
 
 
 class EncoderDecoder():
+    # questions are token id windows and answers token ids instead of one-hot
+    # tensors; encoders pickled before this option existed read it as False
+    sparse = False
+    # the training windows are kept as offsets into the token ids of the texts
+    # and only encoded batch by batch, see `window_batch`
+    streaming = False
+    # at most this many of the most frequent tokens are numbered, when set
+    max_vocab = None
 
-    def __init__(self, maxlen, min_count, unknown, padding, tokenize, untokenize):
+    def __init__(self, maxlen, min_count, unknown, padding, tokenize, untokenize, sparse=False,
+                 streaming=False, max_vocab=None):
+        self.sparse = sparse
+        self.streaming = streaming
+        self.max_vocab = max_vocab
         self.maxlen = maxlen
         self.min_count = min_count
         self.unknown = unknown
@@ -59,9 +267,20 @@ class EncoderDecoder():
         return self.dy.get(y, self.unknown)
 
     def build_coders(self, tokens):
-        tokens = [item for sublist in tokens for item in sublist]
-        word_to_index = {k: v for k, v in Counter(
-            tokens).items() if v >= self.min_count}
+        counts = Counter()
+        for sublist in tokens:
+            counts.update(sublist)
+        return self.coders_from_counts(counts)
+
+    def coders_from_counts(self, counts):
+        """ the token to index and index to token mappings of the tokens counted
+        at least `min_count` times, numbered in the order they were first counted;
+        with `max_vocab` only the most frequent of them """
+        word_to_index = {k: v for k, v in counts.items() if v >= self.min_count}
+        if self.max_vocab is not None and len(word_to_index) > self.max_vocab:
+            # sorted is stable: ties go to the token counted first
+            kept = set(sorted(word_to_index, key=word_to_index.get, reverse=True)[:self.max_vocab])
+            word_to_index = {k: v for k, v in word_to_index.items() if k in kept}
         word_to_index = {k: i for i, (k, v) in enumerate(
             word_to_index.items(), 1)}
         word_to_index[self.unknown] = 0
@@ -69,14 +288,26 @@ class EncoderDecoder():
         index_to_word[0] = self.unknown
         return word_to_index, index_to_word
 
-    def build_qa_coders(self):
-        self.ex, self.dx = self.build_coders(self.questions)
+    def build_qa_coders(self, counts=None):
+        """ the vocabularies of the questions and answers, or of `counts` (`WindowCounts`) """
+        if counts is None:
+            self.ex, self.dx = self.build_coders(self.questions)
+        else:
+            self.ex, self.dx = self.coders_from_counts(counts.questions)
         print("unique question tokens:", len(self.ex))
-        self.ey, self.dy = self.build_coders([self.answers])
+        if counts is None:
+            self.ey, self.dy = self.build_coders([self.answers])
+        else:
+            self.ey, self.dy = self.coders_from_counts(counts.answers)
         print("unique answer tokens:", len(self.ey))
 
     def get_xy(self):
         n = len(self.questions)
+        if self.sparse:
+            X = np.array([[self.encode_x(x) for x in question] for question in self.questions],
+                         dtype=np.int32).reshape((n, self.maxlen))
+            y = np.array([self.encode_y(x) for x in self.answers], dtype=np.int32)
+            return X, y
         X = np.zeros((n, self.maxlen, len(self.ex)), dtype=np.bool)
         y = np.zeros((n, len(self.ey)), dtype=np.bool)
         for num_pair, (question, answer) in enumerate(zip(self.questions, self.answers)):
@@ -85,41 +316,207 @@ class EncoderDecoder():
             y[num_pair, self.encode_y(answer)] = 1
         return X, y
 
+    def answer_frequencies(self):
+        """ how often every answer token id is the answer of a training window """
+        if self.streaming:
+            answers = self.y_ids[np.asarray(self.window_starts) + self.maxlen]
+        else:
+            answers = [self.encode_y(x) for x in self.answers]
+        return np.bincount(answers, minlength=len(self.ey))
+
+    def vocabulary_names(self):
+        """ the name of the tokenizer in `TOKENIZERS` and the separator `untokenize`
+        joins with, None when either cannot be written to a vocabulary file """
+        if isinstance(self.tokenize, TokenizeCache):
+            tokenize = "text_tokenize"
+        else:
+            tokenize = next((k for k, v in TOKENIZERS.items() if v is self.tokenize), None)
+        separator = getattr(self.untokenize, "__self__", None)
+        if tokenize is None or not isinstance(separator, str) or \
+                getattr(self.untokenize, "__name__", None) != "join":
+            return None
+        return tokenize, separator
+
+    def save_vocabulary(self, path):
+        """ writes what inference needs, see `InferenceEncoderDecoder.from_vocabulary` """
+        names = self.vocabulary_names()
+        if names is None:
+            raise ValueError("only tokenizers in TOKENIZERS and str.join untokenizers "
+                             "can be saved as a vocabulary")
+        vocabulary = {"maxlen": self.maxlen, "unknown": self.unknown, "padding": self.padding,
+                      "sparse": self.sparse, "tokenize": names[0], "untokenize": names[1],
+                      "x_tokens": [self.decode_x(i) for i in range(_num_ids(self.dx))],
+                      "y_tokens": [self.decode_y(i) for i in range(_num_ids(self.dy))]}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+
+    def window_batch(self, windows):
+        """ X and y of the training windows with the given numbers, encoded like `get_xy` """
+        starts = self.window_starts[windows]
+        X = self.x_ids[starts[:, None] + np.arange(self.maxlen)]
+        y = self.y_ids[starts + self.maxlen]
+        if self.sparse:
+            return X, y
+        n = len(windows)
+        X_hot = np.zeros((n, self.maxlen, len(self.ex)), dtype=np.bool)
+        X_hot[np.arange(n)[:, None], np.arange(self.maxlen), X] = 1
+        y_hot = np.zeros((n, len(self.ey)), dtype=np.bool)
+        y_hot[np.arange(n), y] = 1
+        return X_hot, y_hot
+
     def pad(self, tokens):
-        seqlen = len(tokens)
-        return [self.padding] * (self.maxlen - seqlen + 1) + tokens
+        return pad_tokens(tokens, self.padding, self.maxlen)
 
     def encode_question(self, text):
-        X = np.zeros((1, self.maxlen, len(self.ex)), dtype=np.bool)
-        prepped = self.pad(self.tokenize(text)[-self.maxlen:])
-        for num, x in enumerate(prepped[1:]):
-            X[0, num, self.encode_x(x)] = 1
+        return self.encode_questions([text])
+
+    def window(self, text):
+        """ the padded tail window of tokens of `text` that the model actually sees """
+        return self.pad(self.tokenize(text)[-self.maxlen:])[1:]
+
+    def window_ids(self, text):
+        return [self.encode_x(x) for x in self.window(text)]
+
+    def encode_questions(self, texts):
+        return self.encode_windows([self.window(text) for text in texts])
+
+    def encode_windows(self, windows):
+        if self.sparse:
+            return np.array([[self.encode_x(x) for x in window] for window in windows],
+                            dtype=np.int32).reshape((len(windows), self.maxlen))
+        X = np.zeros((len(windows), self.maxlen, len(self.ex)), dtype=np.bool)
+        for num_window, window in enumerate(windows):
+            for num, x in enumerate(window):
+                X[num_window, num, self.encode_x(x)] = 1
+        return X
+
+    def encode_tokens(self, tokens):
+        """ encodes a single token per row as a one timestep question """
+        if self.sparse:
+            return np.array([[self.encode_x(x)] for x in tokens], dtype=np.int32).reshape((-1, 1))
+        X = np.zeros((len(tokens), 1, len(self.ex)), dtype=np.bool)
+        for num, token in enumerate(tokens):
+            X[num, 0, self.encode_x(token)] = 1
         return X
 
 
 class TextEncoderDecoder(EncoderDecoder):
     def __init__(self, texts, tokenize=str.split, untokenize=" ".join,
                 window_step=3, maxlen=20, min_count=1,
-                unknown="UNKNOWN", padding="PADDING"):
+                unknown="UNKNOWN", padding="PADDING", sparse=False, streaming=False,
+                max_vocab=None, processes=1, window_cache=None, pool=None):
         self.texts = texts
         self.window_step = window_step
+        # processes tokenizing the texts, or the `pool` of them, see `tokenize_texts`
+        self.processes = processes
+        self.pool = pool
+        # with `streaming`, a `WindowCache` the windows are read from or saved to
+        self.window_cache = window_cache
         c = super(TextEncoderDecoder, self)
-        c.__init__(maxlen, min_count, unknown, padding, tokenize, untokenize)
+        c.__init__(maxlen, min_count, unknown, padding, tokenize, untokenize, sparse, streaming,
+                   max_vocab)
+        # only used while building the data, and cannot be pickled
+        self.pool = None
 
     def build_data(self):
+        if self.streaming:
+            return self.build_windows()
         self.questions = []
         self.answers = []
-        for text in self.texts:
-            tokens = self.tokenize(text)
-            text = self.pad(tokens)
-            seqlen = len(text)
-            for i in range(0, seqlen - self.maxlen, self.window_step):
+        counts = WindowCounts(self.maxlen, self.window_step)
+        for text, text_starts in tokenize_texts(self.texts, self.tokenize, self.processes,
+                                                pool=self.pool, counts=counts,
+                                                padding=self.padding):
+            for i in text_starts:
                 self.questions.append(text[i: i + self.maxlen])
                 self.answers.append(text[i + self.maxlen])
-        self.build_qa_coders()
+        self.build_qa_coders(counts)
         print("number of QA pairs:", len(self.questions))
         return self.get_xy()
 
+    def build_windows(self):
+        """ streaming `build_data`: a single pass over the texts, which may be an
+        iterator and are not kept, that only stores their token ids and the start
+        of every window. The vocabularies are the same as those of `build_data`.
+        All of this is read from the `window_cache` instead, when it has it. """
+        window_cache, self.window_cache = self.window_cache, None
+        if window_cache is not None and window_cache.load(self):
+            self.texts = None
+            return None, None
+        seen = {}
+        ids, starts = [], []
+        counts = WindowCounts(self.maxlen, self.window_step)
+        num_ids = 0
+        for text, text_starts in tokenize_texts(self.texts, self.tokenize, self.processes,
+                                                pool=self.pool, counts=counts,
+                                                padding=self.padding):
+            if not text_starts:
+                continue
+            ids.append(np.array([seen.setdefault(x, len(seen)) for x in text], dtype=np.int32))
+            starts.append(np.arange(text_starts.start, text_starts.stop, text_starts.step) + num_ids)
+            num_ids += len(text)
+        self.texts = None
+        self.build_qa_coders(counts)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+        self.x_ids = np.array([self.encode_x(x) for x in seen], dtype=np.int32)[ids]
+        self.y_ids = np.array([self.encode_y(x) for x in seen], dtype=np.int32)[ids]
+        self.window_starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+        print("number of QA pairs:", len(self.window_starts))
+        if window_cache is not None:
+            window_cache.save(self)
+        return None, None
+
 
 class QuestionAnswerEncoderDecoder(EncoderDecoder):
     pass
+
+
+class InferenceEncoderDecoder(EncoderDecoder):
+    """ only the vocabularies and settings needed to encode questions and decode
+    answers, without the training data; tokens are decoded by list index """
+
+    def __init__(self, maxlen, unknown, padding, tokenize, untokenize, x_tokens, y_tokens,
+                 sparse=False):
+        self.maxlen = maxlen
+        self.min_count = None
+        self.unknown = unknown
+        self.padding = padding
+        self.tokenize = tokenize
+        self.untokenize = untokenize
+        self.sparse = sparse
+        self.dx, self.dy = list(x_tokens), list(y_tokens)
+        self.ex, self.ey = self._lookup(self.dx), self._lookup(self.dy)
+
+    def _lookup(self, tokens):
+        word_to_index = {k: i for i, k in enumerate(tokens[1:], 1)}
+        word_to_index[self.unknown] = 0
+        return word_to_index
+
+    @classmethod
+    def from_vocabulary(cls, path):
+        """ reads a vocabulary written by `EncoderDecoder.save_vocabulary` """
+        with open(path, encoding="utf-8") as f:
+            vocabulary = json.load(f)
+        return cls(vocabulary["maxlen"], vocabulary["unknown"], vocabulary["padding"],
+                   TOKENIZERS[vocabulary["tokenize"]], vocabulary["untokenize"].join,
+                   vocabulary["x_tokens"], vocabulary["y_tokens"], vocabulary["sparse"])
+
+    def decode_x(self, x):
+        return self.dx[x] if 0 <= x < len(self.dx) else self.unknown
+
+    def decode_y(self, y):
+        return self.dy[y] if 0 <= y < len(self.dy) else self.unknown
+
+
+# the tokenizers a saved vocabulary can refer to, by name
+TOKENIZERS = {"text_tokenize": text_tokenize, "list": list, "split": str.split}
+
+
+if __name__ == "__main__":
+    import sys
+    import just
+    # writes the vocabulary of pickled encoders next to them, e.g. models/*.pkl
+    for pkl_path in sys.argv[1:]:
+        vocab_path = pkl_path[:-len(".pkl")] + ".vocab.json"
+        just.read(pkl_path).save_vocabulary(vocab_path)
+        print("wrote", vocab_path)
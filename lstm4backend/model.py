@@ -1,32 +1,61 @@
+import copy
 import os
+import time
 import just
 import numpy as np
-from tensorflow.keras.layers import Activation, Dense, LSTM
-from tensorflow.keras.models import Sequential, load_model
-from tensorflow.keras.optimizers import RMSprop
+
+from encoder_decoder import InferenceEncoderDecoder
+from numpy_lstm import NumpyLSTM
+from sampling import BatchSampler
+
+# tensorflow is imported where it is used, so that models running on the
+# "numpy" engine can be served without it
+
+
+def custom_objects():
+    """ the layers of this package that `load_model` needs to know """
+    from adaptive_softmax import AdaptiveSoftmax
+    return {"AdaptiveSoftmax": AdaptiveSoftmax}
 
 
 class LSTMBase(object):
-    def __init__(self, model_name, encoder_decoder=None, hidden_units=128, base_path="models/"):
+    # sampling from an `AdaptiveSoftmax` output only considers this many of the
+    # most likely tokens, so that most tail clusters need not be scored
+    adaptive_top_k = 2000
+
+    def __init__(self, model_name, encoder_decoder=None, hidden_units=128, base_path="models/",
+                 embedding_dim=64, engine="keras", adaptive_cutoffs=None):
         self.model_name = model_name
+        self.engine = engine
         self.h5_path = os.path.join(base_path, model_name + ".h5")
         self.pkl_path = os.path.join(base_path, model_name + ".pkl")
+        self.vocab_path = os.path.join(base_path, model_name + ".vocab.json")
         self.model = None
+        self.step_model = None
+        self.sampler = BatchSampler()
+        # called with the name and seconds of every decoding phase when set
+        self.on_phase = None
         self.hidden_units = hidden_units
-        if encoder_decoder is None:
+        self.embedding_dim = embedding_dim
+        # frequency ranks where the tail clusters of an `AdaptiveSoftmax` output
+        # start, instead of a full softmax, for new models
+        self.adaptive_cutoffs = adaptive_cutoffs
+        if encoder_decoder is None and os.path.isfile(self.vocab_path):
+            self.encoder_decoder = InferenceEncoderDecoder.from_vocabulary(self.vocab_path)
+        elif encoder_decoder is None:
             self.encoder_decoder = just.read(self.pkl_path)
         else:
             self.encoder_decoder = encoder_decoder
 
     def sample(self, preds, temperature=1.0):
-        preds = np.asarray(preds).astype('float64')
-        preds = np.log(preds) / temperature
-        exp_preds = np.exp(preds)
-        preds = exp_preds / np.sum(exp_preds)
-        probas = np.random.multinomial(1, preds, 1)
-        return np.argmax(probas)
+        return self.sampler.sample(np.asarray(preds)[None], temperature)[0]
 
     def build_model(self):
+        if self.engine == "numpy":
+            return NumpyLSTM.from_h5(self.h5_path)
+        from tensorflow.keras.layers import Activation, Dense, Embedding, LSTM
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.optimizers import RMSprop
         if os.path.isfile(self.h5_path):
             model = self.load()
         else:
@@ -34,54 +63,355 @@ class LSTMBase(object):
             num_unique_q_tokens = len(self.encoder_decoder.ex)
             num_unique_a_tokens = len(self.encoder_decoder.ey)
             model = Sequential()
-            input_s = (None, num_unique_q_tokens)
-            model.add(LSTM(self.hidden_units, input_shape=input_s))
+            if self.encoder_decoder.sparse:
+                model.add(Embedding(num_unique_q_tokens, self.embedding_dim, input_shape=(None,)))
+                model.add(LSTM(self.hidden_units))
+                loss = 'sparse_categorical_crossentropy'
+            else:
+                input_s = (None, num_unique_q_tokens)
+                model.add(LSTM(self.hidden_units, input_shape=input_s))
+                loss = 'categorical_crossentropy'
+            if self.adaptive_cutoffs:
+                from adaptive_softmax import AdaptiveSoftmax
+                output = AdaptiveSoftmax(num_unique_a_tokens, self.adaptive_cutoffs)
+                model.add(output)
+                output.set_frequencies(self.encoder_decoder.answer_frequencies())
+                # trained through `build_training_model`
+                return model
             model.add(Dense(num_unique_a_tokens))
             model.add(Activation('softmax'))
-            optimizer = RMSprop(lr=0.01)
-            model.compile(loss='categorical_crossentropy', optimizer=optimizer)
+            optimizer = RMSprop(learning_rate=0.01)
+            model.compile(loss=loss, optimizer=optimizer)
         return model
 
-    def train(self, test_cases=None, iterations=20, batch_size=256, num_epochs=3, **kwargs):
+    def build_training_model(self):
+        """ the model to fit: the model itself, or for an `AdaptiveSoftmax` output a
+        model of its layers that takes {"question": questions, "answer": answer ids}
+        and has the adaptive softmax loss """
+        from adaptive_softmax import AdaptiveSoftmax
+        from tensorflow.keras.layers import Input
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.optimizers import RMSprop
         if self.model is None:
             self.model = self.build_model()
-        if not hasattr(self.encoder_decoder, "X"):
-            X, y = self.encoder_decoder.get_xy()
-            self.encoder_decoder.X, self.encoder_decoder.y = X, y
-        for iteration in range(iterations):
-            print()
-            print('-' * 50)
-            print('Iteration', iteration)
-            self.model.fit(self.encoder_decoder.X, self.encoder_decoder.y,
-                           batch_size=batch_size, nb_epoch=num_epochs,
-                           **kwargs)
-            self._show_test_cases(test_cases)
-
-    def predict(self, text, diversity, max_prediction_steps, break_at_token=None):
+        output = self.model.layers[-1]
+        if not isinstance(output, AdaptiveSoftmax):
+            return self.model
+        if self.encoder_decoder.sparse:
+            question = Input(shape=(None,), dtype="int32", name="question")
+        else:
+            question = Input(shape=(None, len(self.encoder_decoder.ex)), name="question")
+        answer = Input(shape=(), dtype="int32", name="answer")
+        hidden = question
+        for layer in self.model.layers[:-1]:
+            hidden = layer(hidden)
+        model = Model({"question": question, "answer": answer}, output([hidden, answer]))
+        model.compile(optimizer=RMSprop(learning_rate=0.01))
+        return model
+
+    def train(self, test_cases=None, iterations=20, batch_size=256, num_epochs=3, workers=4,
+              max_queue_size=16, checkpoint_dir=None, checkpoint_every=1000, stats_log=None,
+              tensorboard_dir=None, **kwargs):
+        """ fits the model on the windows of the encoder; those of a streaming
+        encoder are encoded batch by batch on `workers` threads, which keep up
+        to `max_queue_size` batches ready.
+
+        With a `checkpoint_dir`, the model and the training position are saved
+        there after every epoch and, for a streaming encoder, every
+        `checkpoint_every` batches; training resumes from the latest of these
+        checkpoints.
+
+        With a `stats_log`, the throughput of every epoch and the time spent on
+        the test cases are appended to it as JSON lines, see `TrainingStats`,
+        and also written for TensorBoard with a `tensorboard_dir`. """
         if self.model is None:
             self.model = self.build_model()
-        outputs = []
+        state = {"epoch": 0, "batch": 0, "seed": int(np.random.randint(2 ** 31))}
+        callbacks = list(kwargs.pop("callbacks", []))
+        resumed = None
+        if checkpoint_dir is not None:
+            from checkpoint import CheckpointCallback, Checkpoints
+            checkpoints = Checkpoints(checkpoint_dir, custom_objects=custom_objects())
+            resumed = checkpoints.load()
+            if resumed is not None:
+                self.model, state = resumed
+                print("resuming from epoch", state["epoch"], "batch", state["batch"])
+        trainer = self.build_training_model()
+        # the adaptive softmax takes the answers as input
+        answers_as_input = trainer is not self.model
+        if resumed is not None and answers_as_input:
+            # the checkpointed model has no optimizer, the trainer's is saved next to it
+            checkpoints.restore_optimizer(trainer)
+        if self.encoder_decoder.streaming:
+            from batches import WindowBatches
+            batches = WindowBatches(self.encoder_decoder, batch_size, seed=state["seed"],
+                                    answers_as_input=answers_as_input)
+            num_windows = len(self.encoder_decoder.window_starts)
+            if state.setdefault("num_windows", num_windows) != num_windows:
+                raise ValueError("the checkpoint was made with {} windows, not {}".format(
+                    state["num_windows"], num_windows))
+            data = {"x": batches, "workers": workers, "max_queue_size": max_queue_size}
+        else:
+            if not hasattr(self.encoder_decoder, "X"):
+                X, y = self.encoder_decoder.get_xy()
+                self.encoder_decoder.X, self.encoder_decoder.y = X, y
+            data = {"x": self.encoder_decoder.X, "y": self.encoder_decoder.y,
+                    "batch_size": batch_size}
+            if answers_as_input:
+                answers = self.encoder_decoder.y
+                answers = answers if self.encoder_decoder.sparse else answers.argmax(axis=1)
+                data.update(x={"question": self.encoder_decoder.X, "answer": answers}, y=None)
+            # a shuffled epoch cannot be picked up halfway
+            state["batch"] = 0
+        if checkpoint_dir is not None:
+            every_batches = checkpoint_every if self.encoder_decoder.streaming else None
+            callbacks.append(CheckpointCallback(checkpoints, state, every_batches, self.model))
+        stats = None
+        if stats_log is not None:
+            from training_stats import TrainingStats
+            stats = TrainingStats(stats_log, batch_size, tensorboard_dir)
+            callbacks.append(stats)
+        first_epoch = state["epoch"]
+        for epoch in range(first_epoch, iterations * num_epochs):
+            if epoch % num_epochs == 0 or epoch == first_epoch:
+                print()
+                print('-' * 50)
+                print('Iteration', epoch // num_epochs)
+            if self.encoder_decoder.streaming:
+                batches.set_epoch(epoch, state["batch"])
+            trainer.fit(epochs=epoch + 1, initial_epoch=epoch, callbacks=callbacks,
+                        **dict(data, **kwargs))
+            state.update(epoch=epoch + 1, batch=0)
+            if (epoch + 1) % num_epochs == 0:
+                started = time.perf_counter()
+                self._show_test_cases(test_cases)
+                if stats is not None:
+                    stats.sampled(epoch // num_epochs, epoch, time.perf_counter() - started)
+
+    def predict(self, text, diversity, max_prediction_steps, break_at_token=None,
+                stateful=False, top_k=None, top_p=None, deadline=None):
+        return self.predict_batch(text, [diversity], max_prediction_steps,
+                                  break_at_token=break_at_token, stateful=stateful,
+                                  top_k=top_k, top_p=top_p, deadline=deadline)[0]
+
+    def predict_batch(self, text, diversities, max_prediction_steps, break_at_token=None,
+                      stateful=False, top_k=None, top_p=None, deadline=None):
+        """ completes `text` once per diversity, advancing all of them as one batch """
+        outputs = [[] for _ in diversities]
+        for step in self.generate([text] * len(diversities), diversities,
+                                  max_prediction_steps, break_at_token, stateful,
+                                  top_k=top_k, top_p=top_p, deadline=deadline):
+            for row, token in step:
+                outputs[row].append(token)
+        return [self.encoder_decoder.untokenize(x) for x in outputs]
+
+    def generate(self, texts, diversities, max_prediction_steps, break_at_token=None,
+                 stateful=False, cancelled=None, top_k=None, top_p=None, deadline=None):
+        """ yields the (row, token) pairs produced by every decoding step;
+        a row stops being decoded once it produced `break_at_token` or
+        once `cancelled(row)`, which is called after the row's token of the
+        step is produced but before it is yielded, returns True. Each row
+        samples with its own diversity as temperature, see `BatchSampler` for
+        `top_k` and `top_p`. With a `deadline` (a time.monotonic value) decoding
+        stops when another step, taking as long as the last one, would end past it.
+
+        With `stateful` the input window is only run once, after which every
+        generated token is fed as a single timestep on top of the kept LSTM state
+        instead of re-tokenizing and re-encoding the whole growing text.
+
+        With `top_k` and no `top_p` only the `top_k` most likely tokens are
+        computed, see `predict_top_k`, and sampled from. """
+        if self.model is None:
+            self.model = self.build_model()
+        texts = list(texts)
+        active = list(range(len(texts)))
+        last_tokens = {}
+        state = None
+        step_started = time.monotonic()
         for _ in range(max_prediction_steps):
-            X = self.encoder_decoder.encode_question(text)
-            preds = self.model.predict(X, verbose=0)[0]
-            answer_token = self.sample(preds, diversity)
-            new_text_token = self.encoder_decoder.decode_y(answer_token)
-            outputs.append(new_text_token)
-            text += new_text_token
-            if break_at_token is not None and break_at_token == new_text_token:
+            if not active:
+                break
+            step_seconds = time.monotonic() - step_started
+            if deadline is not None and time.monotonic() + step_seconds > deadline:
                 break
-        return self.encoder_decoder.untokenize(outputs)
+            step_started = time.monotonic()
+            started = time.perf_counter()
+            if state is None:
+                windows = [self.encoder_decoder.window(texts[row]) for row in active]
+                started = self._phase("tokenize", started)
+                X = self.encoder_decoder.encode_windows(windows)
+            else:
+                X = self.encoder_decoder.encode_tokens([last_tokens[row] for row in active])
+            started = self._phase("encode", started)
+            temperatures = [diversities[row] for row in active]
+            if top_k is not None and top_p is None:
+                ids, probs, next_state = self.predict_top_k(X, top_k, state)
+                if stateful:
+                    state = next_state
+                started = self._phase("forward", started)
+                choices = self.sampler.sample(probs, temperatures)
+                answer_tokens = ids[np.arange(len(ids)), choices]
+            else:
+                if stateful:
+                    preds, state = self.predict_step(X, state)
+                else:
+                    preds = self.model.predict(X, verbose=0)
+                started = self._phase("forward", started)
+                answer_tokens = self.sampler.sample(preds, temperatures, top_k, top_p)
+            step = []
+            for row, answer_token in zip(active, answer_tokens):
+                new_text_token = self.encoder_decoder.decode_y(answer_token)
+                texts[row] += new_text_token
+                last_tokens[row] = new_text_token
+                step.append((row, new_text_token))
+            self._phase("sample", started)
+            keep = [num for num, (row, token) in enumerate(step)
+                    if (break_at_token is None or token != break_at_token)
+                    and (cancelled is None or not cancelled(row))]
+            if len(keep) < len(active):
+                active = [active[num] for num in keep]
+                if state is not None:
+                    state = [x[keep] for x in state]
+            yield step
+
+    def _phase(self, name, started):
+        now = time.perf_counter()
+        if self.on_phase is not None:
+            self.on_phase(name, now - started)
+        return now
+
+    def beam_search(self, text, beam_width, max_prediction_steps, break_at_token=None,
+                    deadline=None):
+        """ the `beam_width` most likely distinct completions of `text`, best first;
+        all hypotheses of a step are expanded with one batched forward pass.
+        With a `deadline` (a time.monotonic value) the search stops early when
+        another step, taking as long as the last one, would end past it. """
+        if self.model is None:
+            self.model = self.build_model()
+        started = time.monotonic()
+        # the best beam_width continuations overall are among the best
+        # beam_width of every beam, so only those are computed
+        ids, probs, state = self.predict_top_k(
+            self.encoder_decoder.encode_questions([text]), beam_width)
+        beams = [([], 0.0)]
+        finished = []
+        for _ in range(max_prediction_steps):
+            step_seconds = time.monotonic() - started
+            if deadline is not None and time.monotonic() + step_seconds > deadline:
+                break
+            started = time.monotonic()
+            scores = np.log(np.asarray(probs, dtype=np.float64) + 1e-12)
+            scores += np.array([score for _, score in beams])[:, None]
+            scores = scores.ravel()
+            num_candidates = min(beam_width, len(scores))
+            candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            parents, next_beams = [], []
+            for candidate in candidates:
+                parent = int(candidate) // ids.shape[1]
+                answer_token = ids.flat[candidate]
+                tokens = beams[parent][0] + [self.encoder_decoder.decode_y(answer_token)]
+                if break_at_token is not None and tokens[-1] == break_at_token:
+                    finished.append((tokens, scores[candidate]))
+                else:
+                    parents.append(parent)
+                    next_beams.append((tokens, scores[candidate]))
+            beams = next_beams[:max(beam_width - len(finished), 0)]
+            parents = parents[:len(beams)]
+            if not beams:
+                break
+            X = self.encoder_decoder.encode_tokens([tokens[-1] for tokens, _ in beams])
+            ids, probs, state = self.predict_top_k(X, beam_width, [x[parents] for x in state])
+        completions = {}
+        for tokens, score in sorted(finished + beams, key=lambda x: -x[1]):
+            completions.setdefault(self.encoder_decoder.untokenize(tokens), score)
+        return list(completions)[:beam_width]
+
+    def build_step_model(self):
+        """ inference-only copy of the model that also takes and returns the LSTM state """
+        from tensorflow.keras.layers import Input, LSTM
+        from tensorflow.keras.models import Model
+        if self.model is None:
+            self.model = self.build_model()
+        lstm = [x for x in self.model.layers if isinstance(x, LSTM)][0]
+        lstm_index = self.model.layers.index(lstm)
+        config = lstm.get_config()
+        config.pop("batch_input_shape", None)
+        config.update(name=lstm.name + "_step", return_state=True, return_sequences=False)
+        step_lstm = LSTM.from_config(config)
+        if self.encoder_decoder.sparse:
+            question = Input(shape=(None,), dtype="int32")
+        else:
+            question = Input(shape=(None, len(self.encoder_decoder.ex)))
+        inputs = [question, Input(shape=(lstm.units,)), Input(shape=(lstm.units,))]
+        outputs = question
+        for layer in self.model.layers[:lstm_index]:
+            outputs = layer(outputs)
+        outputs, h, c = step_lstm(outputs, initial_state=inputs[1:])
+        step_lstm.set_weights(lstm.get_weights())
+        for layer in self.model.layers[lstm_index + 1:]:
+            outputs = layer(outputs)
+        return Model(inputs, [outputs, h, c])
+
+    def predict_step(self, X, state=None):
+        """ runs X on top of `state` (zeros when None), returns preds and the new state """
+        if self.engine == "numpy":
+            if self.model is None:
+                self.model = self.build_model()
+            return self.model.predict_step(X, state)
+        if self.step_model is None:
+            self.step_model = self.build_step_model()
+        if state is None:
+            units = self.step_model.inputs[1].shape[-1]
+            state = [np.zeros((len(X), units), dtype=np.float32) for _ in range(2)]
+        preds, h, c = self.step_model.predict_on_batch([X] + list(state))
+        return np.asarray(preds), [np.asarray(h), np.asarray(c)]
+
+    @property
+    def sampling_top_k(self):
+        """ the `top_k` to sample with when none is asked for: `adaptive_top_k` for
+        a model with an `AdaptiveSoftmax` output, None otherwise """
+        if self.model is None:
+            self.model = self.build_model()
+        if self.engine == "numpy":
+            adaptive = self.model.adaptive_head is not None
+        else:
+            adaptive = type(self.model.layers[-1]).__name__ == "AdaptiveSoftmax"
+        return self.adaptive_top_k if adaptive else None
+
+    def predict_top_k(self, X, k, state=None):
+        """ `predict_step` for the k most likely tokens of every row: their ids and
+        probabilities, most likely first, and the new state. The "numpy" engine
+        does not score the tail clusters of an `AdaptiveSoftmax` that cannot
+        hold any of them; the "keras" engine computes all probabilities. """
+        if self.engine == "numpy":
+            if self.model is None:
+                self.model = self.build_model()
+            return self.model.predict_top_k(X, k, state)
+        preds, state = self.predict_step(X, state)
+        k = min(k, preds.shape[1])
+        ids = np.argpartition(-preds, k - 1, axis=1)[:, :k]
+        ids = np.take_along_axis(ids, np.argsort(-np.take_along_axis(preds, ids, 1), 1), 1)
+        return ids, np.take_along_axis(preds, ids, 1), state
 
     def save(self):
-        if hasattr(self.encoder_decoder, "X"):
-            del self.encoder_decoder.X
-        if hasattr(self.encoder_decoder, "y"):
-            del self.encoder_decoder.y
-        just.write(self.encoder_decoder, self.pkl_path)
+        """ writes the model, then the vocabulary; an encoder with a tokenizer that a
+        vocabulary file cannot refer to is pickled instead, without its training data """
         self.model.save(self.h5_path)
+        if self.encoder_decoder.vocabulary_names() is not None:
+            self.encoder_decoder.save_vocabulary(self.vocab_path)
+            return
+        encoder_decoder = copy.copy(self.encoder_decoder)
+        for name in ("X", "y", "x_ids", "y_ids", "window_starts"):
+            encoder_decoder.__dict__.pop(name, None)
+        just.write(encoder_decoder, self.pkl_path)
+        # it would be read instead of the pickle
+        if os.path.isfile(self.vocab_path):
+            os.remove(self.vocab_path)
 
     def load(self):
-        return load_model(self.h5_path)
+        from tensorflow.keras.models import load_model
+        return load_model(self.h5_path, custom_objects())
 
     def _show_test_cases(self, test_cases):
         if test_cases is None:
@@ -89,7 +419,9 @@ class LSTMBase(object):
         for test_case in test_cases:
             print('----- Generating with seed: \n\n', test_case)
             print("\n\n--PREDICTION--\n\n")
-            for diversity in [0.2, 0.5, 1]:
+            diversities = [0.2, 0.5, 1]
+            predictions = self.predict_batch(test_case, diversities,
+                                             self.encoder_decoder.maxlen)
+            for diversity, prediction in zip(diversities, predictions):
                 print("--------- diversity {} ------- ".format(diversity))
-                print(self.predict(test_case, diversity,
-                                   self.encoder_decoder.maxlen))
+                print(prediction)
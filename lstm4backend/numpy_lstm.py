@@ -0,0 +1,228 @@
+import json
+
+import h5py
+import numpy as np
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def linear(x):
+    return x
+
+
+ACTIVATIONS = {"sigmoid": sigmoid, "hard_sigmoid": hard_sigmoid, "tanh": np.tanh,
+               "softmax": softmax, "linear": linear, None: linear}
+
+
+def _decode(x):
+    return x.decode("utf-8") if isinstance(x, bytes) else str(x)
+
+
+def read_h5(h5_path):
+    """ the (class name, config, weights) of every layer of a saved Sequential model,
+    read with h5py only; Keras 1 LSTM weights are merged into the Keras 2 layout.
+
+    The configs are matched to their weights by layer name, since tf.keras lists
+    an InputLayer in the config that has no weights; it is left out. """
+    with h5py.File(h5_path, "r") as f:
+        config = json.loads(_decode(f.attrs["model_config"]))["config"]
+        if isinstance(config, dict):
+            config = config["layers"]
+        group = f["model_weights"] if "model_weights" in f else f
+        layer_names = [_decode(x) for x in group.attrs["layer_names"]]
+        layers = []
+        for num, layer_config in enumerate(x for x in config if x["class_name"] != "InputLayer"):
+            # Keras 1 configs may not name their layers, they are in the same order
+            layer_name = layer_config["config"].get("name", layer_names[num])
+            layer_group = group[layer_name]
+            weights = [np.asarray(layer_group[_decode(x)], dtype=np.float32)
+                       for x in layer_group.attrs["weight_names"]]
+            layers.append((layer_config["class_name"], layer_config["config"], weights))
+    return layers
+
+
+def _lstm_weights(config, weights):
+    if len(weights) == 3:
+        kernel, recurrent_kernel, bias = weights
+        recurrent_activation = config.get("recurrent_activation", "hard_sigmoid")
+    else:
+        # Keras 1 stores W, U and b per gate in the order i, c, f, o
+        i, c, f, o = [weights[num:num + 3] for num in range(0, 12, 3)]
+        kernel, recurrent_kernel, bias = [np.concatenate([x[num] for x in [i, f, c, o]], axis=-1)
+                                          for num in range(3)]
+        recurrent_activation = config.get("inner_activation", "hard_sigmoid")
+    return kernel, recurrent_kernel, bias, config.get("activation", "tanh"), recurrent_activation
+
+
+class AdaptiveHead(object):
+    """ NumPy version of the `AdaptiveSoftmax` layer, which can also give the k
+    most likely tokens without scoring every tail cluster """
+
+    def __init__(self, weights, cutoffs, units):
+        self.head_kernel, self.head_bias = weights[:2]
+        self.tails = [weights[num:num + 3] for num in range(2, len(weights) - 1, 3)]
+        self.ranks = weights[-1].astype(np.int64)
+        self.token_ids = np.argsort(self.ranks)
+        self.cutoffs = list(cutoffs)
+        self.head_size = self.cutoffs[0] if self.cutoffs else units
+
+    def _tail(self, num, hidden):
+        projection, kernel, bias = self.tails[num]
+        return softmax(np.dot(np.dot(hidden, projection), kernel) + bias)
+
+    def __call__(self, hidden):
+        head = softmax(np.dot(hidden, self.head_kernel) + self.head_bias)
+        by_rank = [head[:, :self.head_size]]
+        for num in range(len(self.tails)):
+            by_rank.append(head[:, self.head_size + num:self.head_size + num + 1] *
+                           self._tail(num, hidden))
+        return np.concatenate(by_rank, axis=1)[:, self.ranks]
+
+    def top_k(self, hidden, k):
+        """ the token ids and probabilities of the k most likely tokens of every row,
+        most likely first. A tail cluster is only scored for the rows where its
+        total probability is above the k-th best probability found before it. """
+        head = softmax(np.dot(hidden, self.head_kernel) + self.head_bias)
+        k = min(k, len(self.ranks))
+        probs, ranks = _top_k(head[:, :self.head_size], np.arange(self.head_size), k)
+        for num, low in enumerate(self.cutoffs):
+            cluster = head[:, self.head_size + num]
+            rows = np.flatnonzero(cluster > probs.min(axis=1))
+            if not len(rows):
+                continue
+            tail = cluster[rows, None] * self._tail(num, hidden[rows])
+            probs[rows], ranks[rows] = _top_k(np.concatenate([probs[rows], tail], axis=1),
+                                              np.concatenate([ranks[rows], np.tile(
+                                                  np.arange(low, low + tail.shape[1]),
+                                                  (len(rows), 1))], axis=1), k)
+        order = np.argsort(-probs, axis=1)
+        return (self.token_ids[np.take_along_axis(ranks, order, axis=1)],
+                np.take_along_axis(probs, order, axis=1))
+
+
+def _top_k(probs, ranks, k):
+    """ the k largest probabilities of every row and their ranks, padded with
+    zero probabilities when a row has fewer than k """
+    ranks = np.broadcast_to(ranks, probs.shape)
+    if probs.shape[1] < k:
+        padding = k - probs.shape[1]
+        probs = np.pad(probs, ((0, 0), (0, padding)))
+        ranks = np.pad(ranks, ((0, 0), (0, padding)))
+    best = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(probs, best, axis=1), np.take_along_axis(ranks, best, axis=1)
+
+
+class NumpyLSTM(object):
+    """ NumPy inference engine for the [Embedding] -> LSTM -> Dense -> softmax (or
+    `AdaptiveSoftmax`) models built by `LSTMBase`
+
+    The input side of the LSTM is a lookup table with one row of gate
+    pre-activations per input token (the LSTM kernel, or the embeddings times
+    the kernel), so a step costs a gather plus one (batch, units) x (units, 4 units)
+    product. It takes the same one-hot or id inputs as the Keras model, and offers
+    `predict` and `predict_step` like `LSTMBase`. """
+
+    def __init__(self, input_table, recurrent_kernel, bias, activation, recurrent_activation,
+                 output_layers, adaptive_head=None):
+        self.input_table = input_table
+        self.recurrent_kernel = recurrent_kernel
+        self.bias = bias
+        self.units = recurrent_kernel.shape[0]
+        self.activation = ACTIVATIONS[activation]
+        self.recurrent_activation = ACTIVATIONS[recurrent_activation]
+        self.output_layers = output_layers
+        # an `AdaptiveHead` after the output layers, in place of a softmax
+        self.adaptive_head = adaptive_head
+        self._buffers = {}
+
+    @classmethod
+    def from_h5(cls, h5_path):
+        embeddings, lstm, output_layers, adaptive_head = None, None, [], None
+        for class_name, config, weights in read_h5(h5_path):
+            if class_name == "Embedding":
+                embeddings = weights[0]
+            elif class_name == "LSTM":
+                lstm = _lstm_weights(config, weights)
+            elif class_name == "Dense":
+                output_layers.append((weights[0], weights[1], config.get("activation")))
+            elif class_name == "Activation":
+                output_layers.append((None, None, config["activation"]))
+            elif class_name == "AdaptiveSoftmax":
+                adaptive_head = AdaptiveHead(weights, config["cutoffs"], config["units"])
+            else:
+                raise ValueError("cannot run a {} layer with NumPy".format(class_name))
+        kernel, recurrent_kernel, bias, activation, recurrent_activation = lstm
+        input_table = kernel if embeddings is None else np.dot(embeddings, kernel)
+        return cls(np.ascontiguousarray(input_table, dtype=np.float32), recurrent_kernel, bias,
+                   activation, recurrent_activation, output_layers, adaptive_head)
+
+    def _gates(self, n):
+        if n not in self._buffers:
+            self._buffers[n] = np.empty((n, 4 * self.units), dtype=np.float32)
+        return self._buffers[n]
+
+    def predict(self, X, verbose=0):
+        return self.predict_step(X)[0]
+
+    def predict_step(self, X, state=None):
+        """ runs X on top of `state` (zeros when None), returns preds and the new state """
+        h, c = self._run(X, state)
+        outputs = self._output_layers(h)
+        if self.adaptive_head is not None:
+            outputs = self.adaptive_head(outputs)
+        return outputs, [h, c]
+
+    def predict_top_k(self, X, k, state=None):
+        """ `predict_step` for the k most likely tokens only: their ids and
+        probabilities, most likely first, and the new state """
+        h, c = self._run(X, state)
+        outputs = self._output_layers(h)
+        if self.adaptive_head is not None:
+            ids, probs = self.adaptive_head.top_k(outputs, k)
+        else:
+            k = min(k, outputs.shape[1])
+            ids = np.argpartition(-outputs, k - 1, axis=1)[:, :k]
+            probs = np.take_along_axis(outputs, ids, axis=1)
+            order = np.argsort(-probs, axis=1)
+            ids, probs = np.take_along_axis(ids, order, 1), np.take_along_axis(probs, order, 1)
+        return ids, probs, [h, c]
+
+    def _output_layers(self, outputs):
+        for kernel, bias, activation in self.output_layers:
+            if kernel is not None:
+                outputs = np.dot(outputs, kernel) + bias
+            outputs = ACTIVATIONS[activation](outputs)
+        return outputs
+
+    def _run(self, X, state):
+        X = np.asarray(X)
+        ids = X.argmax(axis=-1) if X.ndim == 3 else X
+        n, u = len(ids), self.units
+        if state is None:
+            h = np.zeros((n, u), dtype=np.float32)
+            c = np.zeros((n, u), dtype=np.float32)
+        else:
+            h, c = [np.array(x, dtype=np.float32) for x in state]
+        z = self._gates(n)
+        for t in range(ids.shape[1]):
+            np.dot(h, self.recurrent_kernel, out=z)
+            z += self.input_table[ids[:, t]]
+            z += self.bias
+            i = self.recurrent_activation(z[:, :u])
+            f = self.recurrent_activation(z[:, u:2 * u])
+            o = self.recurrent_activation(z[:, 3 * u:])
+            c *= f
+            c += i * self.activation(z[:, 2 * u:3 * u])
+            h = o * self.activation(c)
+        return h, c
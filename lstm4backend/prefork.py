@@ -0,0 +1,110 @@
+import gc
+import os
+import signal
+import socket
+import sys
+
+import click
+import numpy as np
+from werkzeug.serving import make_server
+
+import serve
+
+
+def cpu_sets(num_workers):
+    """ splits the CPUs this process may use into `num_workers` disjoint sets """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if len(cpus) < num_workers:
+        return [None] * num_workers
+    return [cpus[num::num_workers] for num in range(num_workers)]
+
+
+def preload_models(model_names):
+    """ loads the models into this process, before forking, so the workers share them """
+    for model_name in model_names:
+        try:
+            model = serve.get_model(model_name, **serve.model_options)
+            model.model = model.build_model()
+        except (IOError, OSError) as e:
+            print("could not preload", model_name, ":", e)
+            continue
+        serve.preloaded[model_name] = model
+        print("preloaded", model_name)
+
+
+def listen(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, host, port, cpus, warm_up=()):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    # the random states were copied from the parent, so every worker would draw the same samples
+    np.random.seed()
+    for model in serve.preloaded.values():
+        model.sampler.random.seed()
+    serve.registry.warm_up(warm_up)
+    server = make_server(host, port, serve.app, threaded=True, fd=sock.fileno())
+    server.serve_forever()
+
+
+def spawn(sock, host, port, cpus, warm_up=()):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            run_worker(sock, host, port, cpus, warm_up)
+        finally:
+            os._exit(1)
+    return pid
+
+
+@click.command()
+@click.option('--host', default='0.0.0.0', type=str,
+              help='Host IP')
+@click.option('-p', '--port', default=9078, type=int,
+              help='Host Port')
+@click.option('--workers', default=os.cpu_count(), type=int,
+              help='Number of worker processes')
+@click.option('--preload', multiple=True,
+              help='Model to load before forking, can be repeated; defaults to all models')
+@serve.serving_options
+def main(host, port, workers, preload, **options):
+    """ pre-fork serving: the models are loaded once in this process and the workers
+    forked from it share their weights and vocabularies copy-on-write. All workers
+    accept connections from the same listening socket, which spreads the requests
+    across them, and each worker is pinned to its own CPUs.
+
+    Only the NumPy engine is preloaded, as TensorFlow does not survive a fork;
+    with the Keras engine every worker loads its own models. """
+    # threads do not survive a fork: every worker warms up its own batchers
+    warm_up = options.pop("warm_up")
+    serve.configure(warm_up=(), **options)
+    if serve.model_options["engine"] == "numpy":
+        preload_models(preload or warm_up or serve.registry.available())
+    gc.freeze()
+    sock = listen(host, port)
+    children = {spawn(sock, host, port, cpus, warm_up): cpus for cpus in cpu_sets(workers)}
+    print("serving on {}:{} with {} workers".format(host, port, len(children)))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while children:
+            pid, status = os.wait()
+            cpus = children.pop(pid, None)
+            print("worker", pid, "exited with status", status, ", restarting")
+            children[spawn(sock, host, port, cpus, warm_up)] = cpus
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def resident_bytes():
+    """ resident set size of this process, None where /proc is not available """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def file_bytes(model_name, base_path="models/"):
+    vocab_path = os.path.join(base_path, model_name + ".vocab.json")
+    encoder_ext = ".vocab.json" if os.path.isfile(vocab_path) else ".pkl"
+    paths = [os.path.join(base_path, model_name + ext) for ext in [".h5", encoder_ext]]
+    return sum(os.path.getsize(x) for x in paths if os.path.isfile(x))
+
+
+class ModelRegistry(object):
+    """ loads models on first use and keeps the resident ones under a memory budget
+
+    `loader(model_name)` builds whatever should be kept for a model. Loads run
+    on a single background thread, so a request for a cold model only waits for
+    that model while requests for resident models are served as usual. The
+    memory of a model is the growth of the resident set while it was loaded,
+    and never less than the size of its files. When the total goes over
+    `budget_bytes`, the least recently used models are dropped, calling
+    `on_evict` on them. """
+
+    def __init__(self, loader, base_path="models/", budget_bytes=None, on_evict=None):
+        self.loader = loader
+        self.base_path = base_path
+        self.budget_bytes = budget_bytes
+        self.on_evict = on_evict
+        self.memory = {}
+        self.load_times = {}
+        self._models = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="model-loader")
+
+    def available(self):
+        return sorted(set([x.split(".")[0] for x in os.listdir(self.base_path)]) | set(self._models))
+
+    def loaded(self):
+        """ the resident models by name """
+        with self._lock:
+            return dict(self._models)
+
+    def get(self, model_name):
+        with self._lock:
+            if model_name in self._models:
+                self._models.move_to_end(model_name)
+                return self._models[model_name]
+            future = self._load_async(model_name)
+        return future.result()
+
+    def warm_up(self, model_names):
+        with self._lock:
+            return [self._load_async(x) for x in model_names if x not in self._models]
+
+    def _load_async(self, model_name):
+        if model_name not in self._loading:
+            self._loading[model_name] = self._executor.submit(self._load, model_name)
+        return self._loading[model_name]
+
+    def _load(self, model_name):
+        t0 = time.time()
+        before = resident_bytes()
+        try:
+            model = self.loader(model_name)
+        except Exception:
+            with self._lock:
+                del self._loading[model_name]
+            raise
+        after = resident_bytes()
+        grown = after - before if before is not None and after is not None else 0
+        with self._lock:
+            del self._loading[model_name]
+            self.memory[model_name] = max(grown, file_bytes(model_name, self.base_path))
+            self.load_times[model_name] = time.time() - t0
+            self._models[model_name] = model
+            evicted = self._evict(keep=model_name)
+        for name, evicted_model in evicted:
+            print("evicted model", name)
+            if self.on_evict is not None:
+                self.on_evict(name, evicted_model)
+        return model
+
+    def _evict(self, keep):
+        evicted = []
+        if self.budget_bytes is None:
+            return evicted
+        while sum(self.memory[x] for x in self._models) > self.budget_bytes:
+            name = next(x for x in self._models if x != keep) if len(self._models) > 1 else None
+            if name is None:
+                break
+            evicted.append((name, self._models.pop(name)))
+            del self.memory[name]
+        return evicted
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+class BatchSampler(object):
+    """ draws one index per row from a batch of probability rows
+
+    Every row gets its own temperature; a temperature of 0 picks the most likely
+    index (greedy). `top_k` keeps only the k most likely indices of a row and
+    `top_p` the smallest set of most likely indices whose probability reaches p.
+    The work buffers are kept between calls, so one sampler should not be shared
+    between threads. """
+
+    def __init__(self, seed=None):
+        self.random = np.random.RandomState(seed)
+        self._buffers = {}
+
+    def _buffer(self, name, shape):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1:] != shape[1:]:
+            buffer = np.empty(shape, dtype=np.float64)
+            self._buffers[name] = buffer
+        return buffer[:shape[0]]
+
+    def sample(self, preds, temperatures=1.0, top_k=None, top_p=None):
+        preds = np.asarray(preds)
+        n, vocab_size = preds.shape
+        temperatures = np.broadcast_to(np.asarray(temperatures, dtype=np.float64), (n,))
+        greedy = temperatures <= 0
+        probs = self._buffer("probs", preds.shape)
+        np.maximum(preds, 1e-30, out=probs)
+        np.log(probs, out=probs)
+        probs /= np.where(greedy, 1.0, temperatures)[:, None]
+        probs -= probs.max(axis=1, keepdims=True)
+        np.exp(probs, out=probs)
+        if top_k is not None and top_k < vocab_size:
+            kth = np.partition(probs, vocab_size - top_k, axis=1)[:, vocab_size - top_k]
+            probs[probs < kth[:, None]] = 0
+        if top_p is not None and top_p < 1:
+            order = np.argsort(-probs, axis=1)
+            sorted_probs = np.take_along_axis(probs, order, axis=1)
+            cumulative = np.cumsum(sorted_probs, axis=1)
+            before = (cumulative - sorted_probs) / cumulative[:, -1:]
+            np.put_along_axis(probs, order, np.where(before < top_p, sorted_probs, 0), axis=1)
+        cdf = self._buffer("cdf", preds.shape)
+        np.cumsum(probs, axis=1, out=cdf)
+        thresholds = self.random.random_sample(n) * cdf[:, -1]
+        choices = np.minimum((cdf < thresholds[:, None]).sum(axis=1), vocab_size - 1)
+        if greedy.any():
+            choices[greedy] = preds[greedy].argmax(axis=1)
+        return choices
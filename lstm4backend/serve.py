@@ -1,20 +1,102 @@
-import os
+import json
+import threading
+import time
 from cors import crossdomain
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
 import click
 
-from train import complete
+from batching import Closed, MicroBatcher
+from cache import CompletionCache
+from encoder_decoder import TokenizeCache
+from metrics import Counter, Gauge, Histogram, Registry
+from registry import ModelRegistry
 from train import get_model
+from train import predict_completions
+from train import to_suggestions
 import numpy as np
 
 
-def read_models(base_path="models/"):
-    return set([x.split(".")[0] for x in os.listdir(base_path)])
+app = Flask(__name__, static_folder='../ui/build', )
 
+cache = CompletionCache()
+batch_options = {"max_wait_ms": 2.0, "max_batch": 16}
+model_options = {"engine": "keras"}
+# models loaded ahead of time, e.g. before forking workers, see prefork.py
+preloaded = {}
+# requests are appended to this file for replay with benchmark.py
+capture_log = None
+capture_lock = threading.Lock()
 
-app = Flask(__name__, static_folder='../ui/build', )
 
-models = {x: get_model(x) for x in read_models()}
+def load_batcher(model_name):
+    model = preloaded.get(model_name)
+    if model is None:
+        model = get_model(model_name, **model_options)
+        model.model = model.build_model()
+    model.on_phase = lambda phase, seconds: phase_seconds.observe(seconds, model_name, phase)
+    batcher = MicroBatcher(model, **batch_options)
+    batcher.on_steps = lambda steps: steps_per_request.observe(steps, model_name)
+    return batcher
+
+
+def close_batcher(model_name, batcher):
+    batcher.close()
+
+
+registry = ModelRegistry(load_batcher, on_evict=close_batcher)
+
+
+def get_batcher(model_name):
+    return registry.get(model_name)
+
+
+def with_batcher(model_name, fn):
+    """ fn(batcher) of the model; when the batcher was evicted and closed in the
+    meantime, once more with the batcher of the model loaded again """
+    try:
+        return fn(get_batcher(model_name))
+    except Closed:
+        return fn(get_batcher(model_name))
+
+
+def tokenize_cache_stats():
+    stats = {}
+    for model_name, batcher in registry.loaded().items():
+        tokenize = batcher.encoder_decoder.tokenize
+        if isinstance(tokenize, TokenizeCache):
+            stats[(model_name, "hits")] = tokenize.hits
+            stats[(model_name, "misses")] = tokenize.misses
+    return stats
+
+
+metrics = Registry()
+requests_total = metrics.add(Counter(
+    "autocomplete_requests_total", "Completion requests", ("model", "endpoint")))
+request_seconds = metrics.add(Histogram(
+    "autocomplete_request_seconds", "Time to answer a /predict request", ("model",)))
+phase_seconds = metrics.add(Histogram(
+    "autocomplete_phase_seconds", "Time per decoding step spent in each phase", ("model", "phase")))
+steps_per_request = metrics.add(Histogram(
+    "autocomplete_steps_per_request", "Decoding steps generated per request", ("model",),
+    buckets=(1, 2, 5, 10, 20, 40, 80)))
+metrics.add(Gauge(
+    "autocomplete_queue_depth", "Requests waiting for the model's batcher",
+    lambda: {(k,): v.queue.qsize() for k, v in registry.loaded().items()}, ("model",)))
+metrics.add(Gauge(
+    "autocomplete_step_seconds", "Running estimate of the time one decoding step takes",
+    lambda: {(k,): v.step_costs.seconds or 0 for k, v in registry.loaded().items()}, ("model",)))
+metrics.add(Gauge(
+    "autocomplete_model_load_seconds", "Time it took to load the model",
+    lambda: {(k,): v for k, v in registry.load_times.items()}, ("model",)))
+metrics.add(Gauge(
+    "autocomplete_model_memory_bytes", "Memory attributed to the resident model",
+    lambda: {(k,): v for k, v in registry.memory.items()}, ("model",)))
+metrics.add(Gauge(
+    "autocomplete_completion_cache", "Completion cache hits, misses, hit ratio, entries and bytes",
+    lambda: {(k,): v for k, v in cache.stats().items()}, ("stat",)))
+metrics.add(Gauge(
+    "autocomplete_tokenize_cache", "Tokenization cache hits and misses",
+    tokenize_cache_stats, ("model", "stat")))
 
 
 def get_args(req):
@@ -25,24 +107,94 @@ def get_args(req):
     return args
 
 
+def capture(args):
+    """ appends the request to the capture log, with its arrival time in `t` """
+    if capture_log is None:
+        return
+    line = json.dumps(dict(args, t=time.time())) + "\n"
+    with capture_lock:
+        capture_log.write(line)
+        capture_log.flush()
+
+
+def run_predict(args):
+    started = time.perf_counter()
+    capture(args)
+    sentence = args.get("keyword", "from ")
+    model_name = args.get("model", "char")
+    requests_total.inc(model_name, "predict")
+    guess = int(args.get("guess", 3))
+    beam = args.get("mode", "sample") == "beam"
+    budget_ms = args.get("budget_ms")
+    diversities = np.logspace(-0.6, 0, num=guess)
+
+    def complete(batcher):
+        if budget_ms is None:
+            return predict_completions(batcher, sentence, diversities, cache=cache, beam=beam)
+        # the budget also covers the time spent waiting for a batch
+        budget = float(budget_ms) / 1000.0 - batch_options["max_wait_ms"] / 1000.0
+        deadline = time.monotonic() + budget
+        steps = batcher.step_costs.steps_within(budget, 80)
+        return predict_completions(batcher, sentence, diversities, cache=cache, beam=beam,
+                                   max_prediction_steps=steps, deadline=deadline)
+
+    predictions = with_batcher(model_name, complete)
+    suggestions = to_suggestions(sentence, predictions)
+    data = {"results": [x.strip() for x in suggestions]}
+    if budget_ms is not None:
+        data["truncated"] = [not x.endswith("\n") for x in predictions]
+    request_seconds.observe(time.perf_counter() - started, model_name)
+    return {"data": data}
+
+
+def run_get_models():
+    return {"data": {"results": registry.available()}}
+
+
 @app.route("/predict", methods=["GET", "POST", "OPTIONS"])
 @crossdomain(origin='*', headers="Content-Type")
 def predict():
+    return jsonify(run_predict(get_args(request)))
+
+
+@app.route("/predict_stream", methods=["GET", "POST", "OPTIONS"])
+@crossdomain(origin='*', headers="Content-Type")
+def predict_stream():
+    """ server-sent events variant of /predict: a `start` event with the current
+    line, then one event per generated token of suggestion `index` """
     args = get_args(request)
     sentence = args.get("keyword", "from ")
     model_name = args.get("model", "char")
-    guess = args.get("guess", 3)
+    guess = int(args.get("guess", 3))
+    requests_total.inc(model_name, "predict_stream")
     diversities = np.logspace(-0.6, 0, num=guess)
-    if model_name not in models:
-        models[model_name] = get_model(model_name)
-    suggestions = complete(models[model_name], sentence, diversities)
-    return jsonify({"data": {"results": [x.strip() for x in suggestions]}})
+    stream = with_batcher(model_name, lambda batcher: batcher.stream(
+        sentence, diversities, max_prediction_steps=80, break_at_token="\n", stateful=True,
+        top_k=batcher.sampling_top_k))
+
+    def events():
+        try:
+            start = {"prefix": sentence.split("\n")[-1], "count": len(diversities)}
+            yield "event: start\ndata: {}\n\n".format(json.dumps(start))
+            for index, token in stream:
+                yield "data: {}\n\n".format(json.dumps({"index": index, "token": token}))
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            stream.close()
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
 
 
 @app.route("/get_models", methods=["GET", "POST", "OPTIONS"])
 @crossdomain(origin='*', headers="Content-Type")
 def get_models():
-    return jsonify({"data": {"results": list(models)}})
+    return jsonify(run_get_models())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), content_type=metrics.content_type)
 
 
 @app.route('/static/<path:path>')
@@ -65,6 +217,47 @@ def favicon():
     return app.send_static_file('favicon.ico')
 
 
+def serving_options(f):
+    """ command line options shared by the serving front-ends, see `configure` """
+    options = [
+        click.option('--cache-size', default=10000, type=int,
+                     help='Maximum number of cached completions, 0 disables the cache'),
+        click.option('--cache-mb', default=64, type=int,
+                     help='Memory cap of the completion cache in MB'),
+        click.option('--cache-ttl', default=600, type=float,
+                     help='Seconds a cached completion stays valid'),
+        click.option('--cache-max-temperature', default=0.3, type=float,
+                     help='Requests sampling above this temperature are not cached'),
+        click.option('--batch-wait-ms', default=2.0, type=float,
+                     help='Milliseconds to wait for concurrent requests to batch together'),
+        click.option('--max-batch', default=16, type=int,
+                     help='Maximum number of requests decoded as one batch'),
+        click.option('--model-budget-mb', default=0, type=int,
+                     help='Memory budget of the loaded models in MB, 0 for no limit'),
+        click.option('--warm-up', multiple=True,
+                     help='Model to load at start up, can be repeated'),
+        click.option('--engine', default='keras', type=click.Choice(['keras', 'numpy']),
+                     help='Run the models with Keras or with the NumPy engine'),
+        click.option('--capture', default=None, type=click.Path(dir_okay=False),
+                     help='Append the /predict requests to this JSONL file, see benchmark.py'),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def configure(cache_size, cache_mb, cache_ttl, cache_max_temperature, batch_wait_ms, max_batch,
+              model_budget_mb, warm_up, engine, capture=None):
+    global cache, capture_log
+    model_options.update(engine=engine)
+    if capture is not None:
+        capture_log = open(capture, "a")
+    cache = CompletionCache(cache_size, cache_mb * 2 ** 20, cache_ttl, cache_max_temperature)
+    batch_options.update(max_wait_ms=batch_wait_ms, max_batch=max_batch)
+    registry.budget_bytes = model_budget_mb * 2 ** 20 if model_budget_mb else None
+    registry.warm_up(warm_up)
+
+
 @click.command()
 @click.option('--host', default='0.0.0.0', type=str,
               help='Host IP')
@@ -72,7 +265,9 @@ def favicon():
               help='Host Port')
 @click.option('--debug', is_flag=True,
               help='Use Debug Mode')
-def main(host, port, debug):
+@serving_options
+def main(host, port, debug, **options):
+    configure(**options)
     app.run(host=host, port=port, debug=debug)
 
 
@@ -1,78 +1,122 @@
 
 import just
 import json
+import os
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
-import pandas as pd
-from pathlib import Path
-pd.set_option('max_colwidth',300)
-
-from encoder_decoder import TextEncoderDecoder, text_tokenize
+from corpus import fingerprint, read_code, shard_paths
+from encoder_decoder import TextEncoderDecoder, TokenizeCache, text_tokenize
 from model import LSTMBase
+from window_cache import WindowCache
 
 TRAINING_TEST_CASES = ["from keras.layers import"]
-columns_long_list = ['repo', 'path', 'url', 'code',
-                        'code_tokens', 'docstring', 'docstring_tokens',
-                        'language', 'partition']
-
-def jsonl_list_to_dataframe(file_list, columns=columns_long_list):
-    return pd.concat([pd.read_json(f,
-                                orient='records',
-                                compression='gzip',
-                                lines=True)[columns]
-                    for f in file_list], sort=False)
-
-def get_data():
+
+
+def get_data(limit=None, partitions=None, pool=None):
+    """ lazily, the code of the training files, or of their first `limit` functions,
+    optionally only those of the given `partitions` (train, valid, test); read
+    by the processes of `pool` when given """
     print("loading data... \n")
-    python_files = sorted(Path('./data/python/').glob('**/*.gz'))
-    pydf = jsonl_list_to_dataframe(python_files)
-    code_data = pydf["code"].to_numpy()
+    python_files = shard_paths('./data/python/')
     # code_data = list(just.multi_read("data/**/*.py").values())
-    print(len(code_data), "\n =====> Sample code as training data: \n", code_data[0])
-    # 只有 30 个训练样本测试
-    return code_data[:30]
+    return islice(read_code(python_files, partitions, pool=pool), limit)
+
 
+def get_window_cache(limit=None, partitions=None):
+    """ the cache of the windows of `get_data(limit, partitions)`, invalidated by changed files """
+    return WindowCache(fingerprint(shard_paths('./data/python/'), limit, partitions))
 
-def train(ted, model_name):
-    lb = LSTMBase(model_name, ted)
+
+def train(ted, model_name, adaptive_cutoffs=None):
+    lb = LSTMBase(model_name, ted, adaptive_cutoffs=adaptive_cutoffs)
+    # a preempted run saves what it has, and resumes from its checkpoints when restarted
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     try:
-        lb.train(test_cases=TRAINING_TEST_CASES)
+        lb.train(test_cases=TRAINING_TEST_CASES,
+                 checkpoint_dir=os.path.join("checkpoints", model_name),
+                 stats_log=os.path.join("logs", model_name + ".jsonl"),
+                 tensorboard_dir=os.environ.get("TENSORBOARD_DIR"))
     except KeyboardInterrupt:
         pass
     print("saving")
     lb.save()
 
 
-def train_char(model_name):
-    data = get_data()
-    # list makes a str "str" into a list ["s","t","r"]
-    ted = TextEncoderDecoder(data, tokenize=list, untokenize="".join, padding=" ",
-                            min_count=1, maxlen=40)
+def train_char(model_name, limit=None):
+    # reading and tokenizing share one process per CPU
+    with ProcessPoolExecutor() as pool:
+        data = get_data(limit, pool=pool)
+        # list makes a str "str" into a list ["s","t","r"]
+        ted = TextEncoderDecoder(data, tokenize=list, untokenize="".join, padding=" ",
+                                min_count=1, maxlen=40, streaming=True, pool=pool,
+                                window_cache=get_window_cache(limit))
     train(ted, model_name)
 
 
-def train_token(model_name):
-    data = get_data()
+def train_token(model_name, limit=None):
+    # reading and tokenizing share one process per CPU
+    with ProcessPoolExecutor() as pool:
+        data = get_data(limit, pool=pool)
 
-    # text tokenize splits source code into python tokens
-    ted = TextEncoderDecoder(data, tokenize=text_tokenize, untokenize="".join, padding=" ",
-                            min_count=1, maxlen=20)
+        # text tokenize splits source code into python tokens
+        ted = TextEncoderDecoder(data, tokenize=text_tokenize, untokenize="".join, padding=" ",
+                                min_count=1, maxlen=20, sparse=True, streaming=True,
+                                pool=pool, window_cache=get_window_cache(limit))
 
-    # print("[Token Training] Loading data...")
-    # python_files = sorted(Path('./data/python/').glob('**/*.gz'))
-    # pydf = jsonl_list_to_dataframe(python_files)
-    # tokens = pydf["code_tokens"]
+    # the token vocabulary is large; only the frequent tokens get a full softmax
+    train(ted, model_name, adaptive_cutoffs=[2000, 10000])
 
-    train(ted, model_name)
 
+def get_model(model_name, engine="keras"):
+    model = LSTMBase(model_name, engine=engine)
+    # served texts mostly extend texts tokenized before
+    if model.encoder_decoder.tokenize is text_tokenize:
+        model.encoder_decoder.tokenize = TokenizeCache()
+    return model
 
-def get_model(model_name):
-    return LSTMBase(model_name)
 
+def predict_completions(model, text, diversities, stateful=True, cache=None, beam=False,
+                        max_prediction_steps=80, deadline=None):
+    """ the raw predictions for `text`: one per diversity, sampled from the
+    `sampling_top_k` most likely tokens of the model, or with `beam` the
+    len(diversities) most likely completions found by beam search.
 
-def complete(model, text, diversities):
-    predictions = [model.predict(text, diversity=d, max_prediction_steps=80,
-                                break_at_token="\n")
-                for d in diversities]
+    Decoding stops early rather than run past `deadline` (a time.monotonic
+    value); a prediction not ending in a newline was cut short. """
+    diversities = [float(d) for d in diversities]
+    top_k = None if beam else model.sampling_top_k
+    if beam:
+        params = ("beam", len(diversities), max_prediction_steps, "\n")
+    else:
+        params = ("sample", tuple(diversities), max_prediction_steps, "\n", stateful, top_k)
+    key = None
+    if cache is not None and cache.cacheable(diversities, beam):
+        window = tuple(model.encoder_decoder.window_ids(text))
+        key = (model.model_name, window) + params
+    predictions = cache.get(key) if key is not None else None
+    if predictions is None:
+        if beam:
+            predictions = model.beam_search(text, len(diversities), max_prediction_steps,
+                                            break_at_token="\n", deadline=deadline)
+        else:
+            predictions = model.predict_batch(text, diversities, max_prediction_steps,
+                                              break_at_token="\n", stateful=stateful,
+                                              deadline=deadline, top_k=top_k)
+        # completions cut short by the deadline would otherwise be served to
+        # requests with more time left
+        if key is not None and (deadline is None or all(x.endswith("\n") for x in predictions)):
+            cache.put(key, tuple(predictions))
+    return predictions
+
+
+def complete(model, text, diversities, stateful=True, cache=None, beam=False):
+    predictions = predict_completions(model, text, diversities, stateful, cache, beam)
+    return to_suggestions(text, predictions)
+
+
+def to_suggestions(text, predictions):
     # returning the latest sentence, + prediction
     suggestions = [text.split("\n")[-1] + x.rstrip("\n") for x in predictions]
     return suggestions
@@ -80,14 +124,16 @@ def complete(model, text, diversities):
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         raise Exception(
-            "expecting model name, such as 'neural' and type (either 'char' or 'token'")
-    model_name = "_".join(sys.argv[1:])
+            "expecting model name, such as 'neural' and type (either 'char' or 'token'"
+            ", optionally followed by the number of functions to train on")
+    model_name = "_".join(sys.argv[1:3])
+    limit = int(sys.argv[3]) if len(sys.argv) == 4 else None
     if sys.argv[2] == "char":
-        train_char(model_name)
+        train_char(model_name, limit)
     elif sys.argv[2] == "token":
-        train_token(model_name)
+        train_token(model_name, limit)
     else:
         msg = "The second argument cannot be {}, but should be either 'char' or 'token'"
         raise Exception(msg.format(sys.argv[2]))
@@ -0,0 +1,85 @@
+import json
+import os
+import resource
+import time
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+
+
+def peak_rss_bytes():
+    """ the peak resident set size of this process """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TrainingStats(Callback):
+    """ throughput of `fit`, appended per epoch as a JSON line to `log_path` and,
+    with a `tensorboard_dir`, written as TensorBoard scalars.
+
+    The time between the end of a batch and the start of the next is counted
+    as waiting for input, the time from start to end of a batch as compute;
+    when input waits take a large part of an epoch, preparing the batches is
+    the bottleneck rather than the LSTM. """
+
+    def __init__(self, log_path, batch_size, tensorboard_dir=None):
+        super(TrainingStats, self).__init__()
+        self.log_path = log_path
+        self.batch_size = batch_size
+        self.writer = None
+        if tensorboard_dir is not None:
+            import tensorflow as tf
+            self.writer = tf.summary.create_file_writer(tensorboard_dir)
+        self._batch_seconds = []
+        self._input_seconds = 0.0
+        self._last = None
+        self._batch_started = None
+        self._epoch_started = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._batch_seconds = []
+        self._input_seconds = 0.0
+        self._epoch_started = self._last = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._batch_started = time.perf_counter()
+        self._input_seconds += self._batch_started - self._last
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last = time.perf_counter()
+        self._batch_seconds.append(self._last - self._batch_started)
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self._epoch_started
+        batch_seconds = np.array(self._batch_seconds or [0.0])
+        samples = len(self._batch_seconds) * self.batch_size
+        record = {"event": "epoch", "epoch": epoch, "batches": len(self._batch_seconds),
+                  "seconds": seconds, "samples_per_second": samples / seconds if seconds else 0.0,
+                  "batch_ms_mean": float(batch_seconds.mean() * 1000),
+                  "batch_ms_p50": float(np.percentile(batch_seconds, 50) * 1000),
+                  "batch_ms_p95": float(np.percentile(batch_seconds, 95) * 1000),
+                  "compute_seconds": float(batch_seconds.sum()),
+                  "input_seconds": self._input_seconds,
+                  "input_fraction": self._input_seconds / seconds if seconds else 0.0,
+                  "peak_rss_bytes": peak_rss_bytes()}
+        record.update({k: float(v) for k, v in (logs or {}).items()})
+        self.write(record, epoch)
+
+    def sampled(self, iteration, epoch, seconds):
+        """ records the time spent sampling the test cases after `iteration` """
+        self.write({"event": "test_cases", "iteration": iteration, "seconds": seconds}, epoch,
+                   prefix="test_cases_")
+
+    def write(self, record, step, prefix=""):
+        record = dict(record, time=time.time())
+        directory = os.path.dirname(self.log_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        if self.writer is not None:
+            import tensorflow as tf
+            with self.writer.as_default():
+                for name, value in record.items():
+                    if name not in ("event", "epoch", "iteration", "time"):
+                        tf.summary.scalar(prefix + name, value, step=step)
+            self.writer.flush()
@@ -0,0 +1,74 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+import numpy as np
+
+ARRAYS = ("x_ids", "y_ids", "window_starts")
+CODERS = ("ex", "dx", "ey", "dy")
+
+
+def tokenizer_id(tokenize):
+    """ the name of `tokenize` and, when it is written in Python, a hash of its module's source """
+    name = "{}.{}".format(getattr(tokenize, "__module__", None),
+                          getattr(tokenize, "__qualname__", type(tokenize).__name__))
+    try:
+        with open(inspect.getfile(tokenize), "rb") as f:
+            return name + ":" + hashlib.sha256(f.read()).hexdigest()
+    except (TypeError, OSError):
+        return name
+
+
+class WindowCache(object):
+    """ the token ids, window starts and vocabularies of a streaming
+    `TextEncoderDecoder`, saved as .npy files that later runs memory-map
+    instead of tokenizing the texts again.
+
+    `source` identifies the texts, e.g. `corpus.fingerprint` of the shards they
+    are read from; together with the tokenizer and the window and vocabulary
+    settings it addresses a directory under `root`. """
+
+    def __init__(self, source, root="cache/"):
+        self.source = source
+        self.root = root
+
+    def key(self, encoder_decoder):
+        config = [self.source, tokenizer_id(encoder_decoder.tokenize), encoder_decoder.maxlen,
+                  encoder_decoder.window_step, encoder_decoder.min_count,
+                  encoder_decoder.max_vocab, encoder_decoder.unknown, encoder_decoder.padding]
+        return hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest()[:32]
+
+    def directory(self, encoder_decoder):
+        return os.path.join(self.root, self.key(encoder_decoder))
+
+    def load(self, encoder_decoder):
+        """ sets the cached data on `encoder_decoder`, returns False when there is none """
+        directory = self.directory(encoder_decoder)
+        if not os.path.isfile(os.path.join(directory, "coders.json")):
+            return False
+        for name in ARRAYS:
+            path = os.path.join(directory, name + ".npy")
+            setattr(encoder_decoder, name, np.load(path, mmap_mode="r"))
+        with open(os.path.join(directory, "coders.json")) as f:
+            coders = json.load(f)
+        for name in CODERS:
+            setattr(encoder_decoder, name, {k: v for k, v in coders[name]})
+        print("loaded {} windows from {}".format(len(encoder_decoder.window_starts), directory))
+        return True
+
+    def save(self, encoder_decoder):
+        """ writes the data of `encoder_decoder`; the directory only appears once complete """
+        directory = self.directory(encoder_decoder)
+        partial = directory + ".{}.partial".format(os.getpid())
+        os.makedirs(partial, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(partial, name + ".npy"), getattr(encoder_decoder, name))
+        with open(os.path.join(partial, "coders.json"), "w") as f:
+            json.dump({name: list(getattr(encoder_decoder, name).items()) for name in CODERS}, f)
+        try:
+            os.rename(partial, directory)
+        except OSError:
+            # saved by another run in the meantime
+            shutil.rmtree(partial, ignore_errors=True)